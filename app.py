@@ -1,53 +1,139 @@
 import sqlite3
-from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, session, flash
+import click
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, redirect, session, flash, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime, timedelta
 import os
+import json
+import hashlib
 import uuid
+import threading
+import time
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from werkzeug.utils import secure_filename
-import pydicom
-from pydicom.pixel_data_handlers import apply_voi_lut
-import matplotlib.pyplot as plt
+from preview import preview_paths, write_previews
+from ingest import ParsedDicom, get_parsed, index_fields, read_header, remember, stored_hash
+from uploads import StreamingRequest, UploadRejected, DICOM_MAGIC, PDF_MAGIC
+from model_client import ModelClient
+from batch import CsvResultWriter, csv_to_parquet, run_batch
+from jobs import JobQueue, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, FINISHED_STATES
 from werkzeug.security import check_password_hash, generate_password_hash
 import requests
 
 # NEW IMPORTS FOR PDF MANIPULATION
-from pypdf import PdfWriter, PdfReader
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch
-from reportlab.lib.pagesizes import letter # Standard letter size for new page
-from reportlab.lib.enums import TA_CENTER # For text alignment
-from io import BytesIO # To handle PDF data in memory without saving temp files for ReportLab
+from reports import build_report, report_filename, stream_zip
+from tiles import TileNotFound, get_tile_source
+from pixel_cache import PixelCache
+from auth import TokenBucketLimiter, needs_rehash
+import telemetry
+from storage import StorageGC, inflated_paths
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.request_class = StreamingRequest
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db') # Relative SQLite paths live in instance/
+app.config['DB_BUSY_TIMEOUT'] = 15 # Seconds a connection waits for a lock before "database is locked"
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 40,
+    'pool_timeout': 30,
+    'connect_args': {
+        'timeout': app.config['DB_BUSY_TIMEOUT'],
+        'check_same_thread': False, # connections move between threads through the pool
+        'cached_statements': 256, # prepared statements kept per connection
+    },
+}
+app.config['LIST_PER_PAGE'] = 50 # Default page size of / and /ver_estudios_pdf
+app.config['LIST_MAX_PER_PAGE'] = 500
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """WAL lets readers run while a write is in progress; NORMAL sync is durable enough with WAL"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
 UPLOAD_FOLDER = 'dicom_uploads'
 PREVIEW_FOLDER = 'static/previews'
 ARCHIVES_FOLDER = 'archives' # For uploaded PDFs
 REPORTS_FOLDER = 'static/reports' # <--- NEW: Folder for generated reports
+REPORT_CACHE_FOLDER = 'report_cache' # Merged source PDFs per study, reused by every report
+TILE_CACHE_FOLDER = 'tile_cache' # Pyramid levels and tiles per DICOM (by content hash)
+PIXEL_CACHE_FOLDER = 'pixel_cache' # Decoded pixel arrays as .npy, shared by previews and tiles
 ALLOWED_EXTENSIONS = {'dcm', 'dicom'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PREVIEW_FOLDER'] = PREVIEW_FOLDER
 app.config['ARCHIVES_FOLDER'] = ARCHIVES_FOLDER
 app.config['REPORTS_FOLDER'] = REPORTS_FOLDER # <--- NEW: Add to app config
+app.config['REPORT_CACHE_FOLDER'] = REPORT_CACHE_FOLDER
+app.config['TILE_CACHE_FOLDER'] = TILE_CACHE_FOLDER
+app.config['PIXEL_CACHE_FOLDER'] = PIXEL_CACHE_FOLDER
+app.config['PIXEL_CACHE_MAX_BYTES'] = 4 * 1024 ** 3 # ~150 decoded full-field mammograms
 app.config['MAX_CONTENT_LENGTH'] = 150 * 1024 * 1024  # 150MB
-
-app.secret_key = 'clave_supersecreta' # Change this to a strong, random key in production!
-
-# Create directories if they don't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PREVIEW_FOLDER, exist_ok=True)
-os.makedirs(ARCHIVES_FOLDER, exist_ok=True)
-os.makedirs(REPORTS_FOLDER, exist_ok=True) # <--- NEW: Create reports folder
-
-# Ensure database exists and tables are created
-if not os.path.exists('instance/database.db'):
-    with app.app_context():
-        db.create_all()
-        print("Database created!")
+app.config['UPLOAD_POOL'] = 'thread' # 'thread' or 'process' for per-file metadata/preview work
+app.config['UPLOAD_WORKERS'] = 4
+app.config['UPLOAD_TIMEOUT'] = 120 # Seconds to wait for each file's metadata/preview
+# Endpoints whose files are streamed to <folder>/<sha256>.<ext> while being checked:
+# endpoint -> (folder config key, allowed extensions, (offset, magic), stored extension)
+app.config['STREAMING_UPLOADS'] = {
+    'upload_file': ('UPLOAD_FOLDER', ALLOWED_EXTENSIONS, DICOM_MAGIC, 'dcm'),
+    'upload_pdf': ('ARCHIVES_FOLDER', {'pdf'}, PDF_MAGIC, 'pdf'),
+}
+
+# Mirai container endpoint(s); several comma-separated URLs are load-balanced
+app.config['MIRAI_ENDPOINTS'] = os.environ.get('MIRAI_ENDPOINTS', 'http://localhost:5000/dicom/files').split(',')
+app.config['MIRAI_CONNECT_TIMEOUT'] = 3.05 # Seconds
+app.config['MIRAI_READ_TIMEOUT'] = 300 # Seconds; one inference can take a while on CPU
+app.config['MIRAI_RETRIES'] = 2 # Extra attempts on connection errors / 5xx
+app.config['MIRAI_RETRY_BACKOFF'] = 0.5 # Seconds, doubled on every retry
+app.config['MIRAI_FAILURE_THRESHOLD'] = 5 # Consecutive failures before an endpoint is skipped
+app.config['MIRAI_RESET_TIMEOUT'] = 30 # Seconds before a skipped endpoint is tried again
+# Cached Mirai predictions are keyed by the submitted files' hashes plus this version,
+# so bump it whenever the model container changes
+app.config['MIRAI_MODEL_VERSION'] = 'ark-mirai'
+app.config['INFERENCE_CACHE_MAX_ENTRIES'] = 10000
+app.config['INFERENCE_CACHE_MAX_AGE_DAYS'] = 90
+app.config['RISK_THRESHOLD_PERCENT'] = 2.9 # 5-year risk at or above this is 'high' (same cut-off as the viewer)
+app.config['SEARCH_MAX_PER_PAGE'] = 200
+app.config['INFERENCE_WORKERS'] = 2 # Threads sending jobs to the Mirai container
+app.config['JOB_POLL_INTERVAL'] = 0.5 # Seconds between status checks in /jobs/<id>/events
+# A job still running after JOB_LEASE seconds is taken to be lost with its worker (killed or recycled) and
+# is queued again; keep it above the slowest inference (MIRAI_READ_TIMEOUT per attempt, MIRAI_RETRIES + 1 attempts)
+app.config['JOB_LEASE'] = 1800
+app.config['JOB_RECOVERY_INTERVAL'] = 60 # Seconds between checks for queued jobs no worker holds and expired leases
+app.config['REPORT_WORKERS'] = os.cpu_count() or 2 # Processes rendering PDF reports
+app.config['REPORT_BULK_MAX'] = 200 # Reports per /reports/bulk request
+
+app.secret_key = os.environ.get('SECRET_KEY', 'clave_supersecreta') # Set SECRET_KEY in production!
+# werkzeug hash method for new and upgraded passwords, e.g. 'scrypt:16384:8:1' or 'pbkdf2:sha256:600000'.
+# Stored hashes made with other parameters are rehashed on the next successful login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['LOGIN_RATE_LIMIT_BURST'] = 5 # Failed logins allowed per user and per IP before blocking
+app.config['LOGIN_RATE_LIMIT_PER_MINUTE'] = 2 # Failed-login allowance regained per minute
+
+app.config['METRICS_FOLDER'] = 'metrics' # Per-process latency histograms, merged by /metrics
+app.config['METRICS_FLUSH_INTERVAL'] = 10 # Seconds between writes of a process's histograms
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')
+app.config['LOG_REQUESTS'] = True # One JSON log line per request with its trace id and stage timings
+# Profile a request with the 'X-Profile: cprofile' (or 'pyinstrument') header; off unless MIRAI_PROFILING=1
+app.config['PROFILING_ENABLED'] = os.environ.get('MIRAI_PROFILING') == '1'
+app.config['PROFILE_FOLDER'] = 'profiles'
+
+app.config['STORAGE_GC_INTERVAL'] = 600 # Seconds between storage GC passes; 0 turns the background GC off
+app.config['STORAGE_GC_BATCH'] = 50 # Files hashed for deduplication / compressed per pass
+app.config['STORAGE_ORPHAN_GRACE'] = 3600 # Unreferenced files younger than this may belong to an upload in progress
+app.config['REPORT_RETENTION_DAYS'] = 30 # Reports and merged sources unused this long are deleted (rebuilt on request)
+app.config['TILE_CACHE_RETENTION_DAYS'] = 14 # Tile pyramids not viewed this long are deleted
+# 'deflate' rewrites uploads older than DICOM_COMPRESS_AFTER_DAYS with the lossless deflated transfer syntax
+app.config['DICOM_COMPRESSION'] = os.environ.get('DICOM_COMPRESSION') or None
+app.config['DICOM_COMPRESS_AFTER_DAYS'] = 7
 
 class metadata(db.Model):
     __tablename__ = 'metadata'
@@ -67,11 +153,11 @@ class PDFStudy(db.Model):
     filename_1 = db.Column(db.String(120))
     filename_2 = db.Column(db.String(120))
     # NEW COLUMN: Add a timestamp for easy retrieval of the most recent study
-    upload_date = db.Column(db.DateTime, default=datetime.now)
+    upload_date = db.Column(db.DateTime, default=datetime.now, index=True)
 
 class medical(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, index=True)
     password = db.Column(db.String(120), nullable=False)
     role = db.Column(db.String(120), nullable=False)
 
@@ -81,32 +167,183 @@ class patient(db.Model):
     password = db.Column(db.String(120), nullable=False)
     role = db.Column(db.String(120), nullable=False)
 
-with app.app_context():
-    db.create_all()
+class StudySession(db.Model):
+    """One examination being worked on: its DICOM views and the PDFs that go with them"""
+    __tablename__ = 'study_session'
+    id = db.Column(db.String(32), primary_key=True)
+    pdf_study_id = db.Column(db.Integer, db.ForeignKey('pdf_study.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    files = db.relationship('StudyFile', backref='study_session', order_by='StudyFile.position', lazy=True)
+    pdf_study = db.relationship('PDFStudy', lazy=True)
+
+class StudyFile(db.Model):
+    __tablename__ = 'study_file'
+    id = db.Column(db.Integer, primary_key=True)
+    study_session_id = db.Column(db.String(32), db.ForeignKey('study_session.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    original_filename = db.Column(db.String(255))
+    stored_filename = db.Column(db.String(120), nullable=False) # <sha256>.dcm in UPLOAD_FOLDER
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    preview = db.Column(db.String(120))
+    dicom_metadata = db.Column(db.Text) # JSON, as returned by extract_dicom_metadata
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+class DicomIndex(db.Model):
+    """Searchable header fields of every stored DICOM, filled at upload or by `flask index-dicoms`"""
+    __tablename__ = 'dicom_index'
+    __table_args__ = (
+        db.Index('ix_dicom_index_date_study', 'study_date', 'study_instance_uid', 'risk_level'),
+        db.Index('ix_dicom_index_patient_date', 'patient_id', 'study_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    stored_filename = db.Column(db.String(255), unique=True, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)
+    study_instance_uid = db.Column(db.String(128), index=True)
+    patient_id = db.Column(db.String(64))
+    patient_name = db.Column(db.String(255), index=True)
+    study_date = db.Column(db.String(8)) # YYYYMMDD as stored in DICOM
+    patient_age = db.Column(db.String(8))
+    patient_sex = db.Column(db.String(8))
+    modality = db.Column(db.String(16))
+    body_part = db.Column(db.String(64))
+    laterality = db.Column(db.String(4))
+    view_position = db.Column(db.String(16))
+    file_size = db.Column(db.Integer)
+    risk_score = db.Column(db.Float) # 5-year prediction, in percent
+    risk_level = db.Column(db.String(10)) # 'high' or 'low'
+    indexed_at = db.Column(db.DateTime, default=datetime.now)
+
+class InferenceCache(db.Model):
+    __tablename__ = 'inference_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    model_version = db.Column(db.String(64), nullable=False)
+    content_hashes = db.Column(db.Text, nullable=False) # Sorted SHA-256 of the views, comma separated
+    predictions = db.Column(db.Text, nullable=False) # JSON array returned by the model
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    last_used = db.Column(db.DateTime, default=datetime.now, index=True)
+    hits = db.Column(db.Integer, default=0)
+
+class InferenceJob(db.Model):
+    __tablename__ = 'inference_job'
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED, index=True)
+    file_paths = db.Column(db.Text, nullable=False) # JSON list of DICOM paths to send
+    result = db.Column(db.Text) # JSON payload returned to the client
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class ReportJob(db.Model):
+    __tablename__ = 'report_job'
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default=JOB_QUEUED, index=True)
+    pdf_study_id = db.Column(db.Integer, db.ForeignKey('pdf_study.id'), nullable=False)
+    percentage = db.Column(db.String(20), nullable=False)
+    risk_message = db.Column(db.String(50), nullable=False)
+    report_filename = db.Column(db.String(255), nullable=False, index=True)
+    result = db.Column(db.Text) # JSON payload returned to the client
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class LoginBucket(db.Model):
+    """Failed-login token bucket of a user or client IP, shared by every worker process"""
+    __tablename__ = 'login_bucket'
+    key = db.Column(db.String(200), primary_key=True) # 'user:<name>' or 'ip:<address>'
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False) # Unix time of the last change
+
+class BatchResult(db.Model):
+    """One study scored by `flask mirai-batch`; finished studies are skipped when a run resumes"""
+    __tablename__ = 'batch_result'
+    __table_args__ = (db.UniqueConstraint('run_id', 'study_uid'),)
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(64), nullable=False, index=True)
+    study_uid = db.Column(db.String(128), nullable=False)
+    patient_id = db.Column(db.String(64))
+    status = db.Column(db.String(20), nullable=False) # done, failed or incomplete
+    predictions = db.Column(db.Text) # JSON array
+    error = db.Column(db.Text)
+    latency = db.Column(db.Float)
+    file_paths = db.Column(db.Text) # JSON list
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+_storage_ready = False
+_storage_lock = threading.Lock()
+
+def init_storage():
+    """Create the data folders, tables and indexes and recover interrupted jobs, once per process.
+
+    Runs from create_app() (in the gunicorn master with preload_app, so forked
+    workers skip it), and otherwise on the first request or CLI command.
+    """
+    global _storage_ready
+    with _storage_lock:
+        if _storage_ready:
+            return
+        for folder_key in ('UPLOAD_FOLDER', 'PREVIEW_FOLDER', 'ARCHIVES_FOLDER', 'REPORTS_FOLDER',
+                           'REPORT_CACHE_FOLDER', 'TILE_CACHE_FOLDER'):
+            os.makedirs(app.config[folder_key], exist_ok=True)
+        telemetry.setup_logging(app.config['LOG_LEVEL'])
+        telemetry.configure(app.config['METRICS_FOLDER'], app.config['METRICS_FLUSH_INTERVAL'])
+        telemetry.compact()
+
+        with app.app_context():
+            db.create_all()
+            # create_all() skips tables that already exist, so indexes added to them later
+            # (e.g. pdf_study.upload_date, medical.name) are created here
+            for table in db.metadata.sorted_tables:
+                for table_index in table.indexes:
+                    table_index.create(db.engine, checkfirst=True)
+
+            # Jobs left running by a previous server go back to the queue; workers
+            # pick up queued jobs when they start
+            for model in (InferenceJob, ReportJob):
+                db.session.execute(db.update(model).where(model.status == JOB_RUNNING).values(status=JOB_QUEUED))
+            db.session.commit()
+        _storage_ready = True
+
+# The database engine is created when this module is imported; use DATABASE_URL to point it elsewhere
+IMPORT_TIME_CONFIG = ('SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_ENGINE_OPTIONS', 'SQLALCHEMY_BINDS')
+
+def create_app(config=None):
+    """Entry point for WSGI servers (see wsgi.py): apply config overrides and prepare storage.
+
+    Everything but the database settings can be overridden here; objects built
+    from config (pools, clients, the login limiter) are created on first use.
+    """
+    if config:
+        fixed = [key for key in IMPORT_TIME_CONFIG if key in config and config[key] != app.config.get(key)]
+        if fixed:
+            raise ValueError(f"{', '.join(fixed)} cannot be changed after import; set DATABASE_URL instead")
+        app.config.update(config)
+    init_storage()
+    return app
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_preview(dcm_path, preview_path):
-    """Generate a PNG preview from DICOM file"""
+def generate_preview(dcm_source, preview_path):
+    """Generate PNG previews (viewer, thumb and full sizes) from a DICOM path or ParsedDicom"""
     try:
-        ds = pydicom.dcmread(dcm_path)
-        data = apply_voi_lut(ds.pixel_array, ds)
-        data = (data - data.min()) / (data.max() - data.min()) * 255.0
-        data = data.astype('uint8')
-
-        plt.figure(figsize=(4, 4), dpi=100)
-        plt.imshow(data, cmap=plt.cm.gray)
-        plt.axis('off')
-        plt.savefig(preview_path, bbox_inches='tight', pad_inches=0)
-        plt.close()
+        if isinstance(dcm_source, ParsedDicom):
+            write_previews(dcm_source.dataset, preview_path, pixels=dcm_source.pixels)
+        else:
+            write_previews(dcm_source, preview_path)
         return True
     except Exception as e:
-        print(f"Preview generation failed: {str(e)}")
+        telemetry.log.warning(f"Preview generation failed: {str(e)}")
         return False
 
-def extract_dicom_metadata(dcm_path):
+def extract_dicom_metadata(dcm_source):
+    """Header fields shown in the viewer, from a DICOM path or ParsedDicom.
+
+    Only the header is read: a ParsedDicom keeps its pixel data deferred and
+    a plain path is read with stop_before_pixels.
+    """
+    dcm_path = dcm_source.path if isinstance(dcm_source, ParsedDicom) else dcm_source
     metadata = {
         'PatientName': 'N/A',
         'PatientID': 'N/A',
@@ -118,7 +355,7 @@ def extract_dicom_metadata(dcm_path):
         'FileSize': 'N/A'
     }
     try:
-        ds = pydicom.dcmread(dcm_path)
+        ds = dcm_source.dataset if isinstance(dcm_source, ParsedDicom) else read_header(dcm_path)
 
         if 'PatientName' in ds and ds.PatientName:
             metadata['PatientName'] = str(ds.PatientName)
@@ -128,80 +365,724 @@ def extract_dicom_metadata(dcm_path):
                 metadata[tag] = str(ds[tag].value)
 
     except Exception as e:
-        print(f"Error extracting metadata from {dcm_path}: {e}")
+        telemetry.log.warning(f"Error extracting metadata from {dcm_path}: {e}")
 
     try:
         metadata['FileSize'] = f"{os.path.getsize(dcm_path) / (1024 * 1024):.2f} MB"
     except Exception as e:
-        print(f"Error getting file size for {dcm_path}: {e}")
+        telemetry.log.warning(f"Error getting file size for {dcm_path}: {e}")
         metadata['FileSize'] = 'N/A'
 
     return metadata
 
+def reuse_previews(preview_path):
+    """True if every preview size exists already (previews are named after the DICOM's hash).
+
+    Touches them, so the storage GC does not delete them as old orphans.
+    """
+    try:
+        for path in preview_paths(preview_path).values():
+            os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def process_upload(dicom_path, content_hash, preview_path):
+    """Metadata, index fields and previews for one saved upload; runs on the upload pool.
+
+    Also returns the stage spans it recorded, for the upload request's trace.
+    """
+    parsed = ParsedDicom(dicom_path, content_hash, get_pixel_cache())
+    with telemetry.recorded_spans() as spans:
+        try:
+            metadata_for_file = extract_dicom_metadata(parsed)
+            try:
+                fields = index_fields(parsed.dataset)
+            except Exception as e:
+                telemetry.log.warning(f"Error reading index fields from {dicom_path}: {e}")
+                fields = None
+            preview_ok = reuse_previews(preview_path) or generate_preview(parsed, preview_path)
+        finally:
+            parsed.release()
+    return metadata_for_file, preview_ok, fields, spans
+
+def index_dicom_file(stored_filename, content_hash, fields, file_size=None):
+    """Insert or refresh the dicom_index row of a stored file (caller commits)"""
+    entry = DicomIndex.query.filter_by(stored_filename=stored_filename).first()
+    if entry is None:
+        entry = DicomIndex(stored_filename=stored_filename)
+        db.session.add(entry)
+    entry.content_hash = content_hash
+    entry.file_size = file_size
+    entry.indexed_at = datetime.now()
+    for column, value in fields.items():
+        setattr(entry, column, value)
+    return entry
+
+def record_risk(content_hashes, predictions):
+    """Store the 5-year risk on the indexed images it was computed from"""
+    if len(predictions) < 5:
+        return
+    risk_score = float(predictions[4]) * 100
+    risk_level = 'high' if risk_score >= app.config['RISK_THRESHOLD_PERCENT'] else 'low'
+    DicomIndex.query.filter(DicomIndex.content_hash.in_(content_hashes)) \
+        .update({'risk_score': risk_score, 'risk_level': risk_level}, synchronize_session=False)
+    db.session.commit()
+
+def backfill_dicom_index(folder, commit_every=500, log=telemetry.log.info):
+    """Index every DICOM in folder that is not indexed yet, reading headers only"""
+    known = {name for (name,) in db.session.query(DicomIndex.stored_filename)}
+    indexed = 0
+    for item in os.scandir(folder):
+        if not item.is_file() or not allowed_file(item.name) or item.name in known:
+            continue
+        try:
+            fields = index_fields(read_header(item.path))
+        except Exception as e:
+            log(f"Skipping {item.name}: {e}")
+            continue
+        # Content-addressed uploads are named <sha256>.dcm; older uploads have no known hash
+        index_dicom_file(item.name, stored_hash(item.name), fields, item.stat().st_size)
+        indexed += 1
+        if indexed % commit_every == 0:
+            db.session.commit()
+            log(f"Indexed {indexed} files...")
+    db.session.commit()
+    return indexed
+
+_indexer_thread = None
+
+def start_background_indexer():
+    """Back-fill the index from UPLOAD_FOLDER on a daemon thread; no-op if one is running"""
+    global _indexer_thread
+    if _indexer_thread is not None and _indexer_thread.is_alive():
+        return False
+
+    def run():
+        with app.app_context():
+            count = backfill_dicom_index(app.config['UPLOAD_FOLDER'])
+            telemetry.log.info(f"Background indexer finished: {count} files indexed")
+
+    _indexer_thread = threading.Thread(target=run, name='dicom-indexer', daemon=True)
+    _indexer_thread.start()
+    return True
+
+def get_or_create_study_session(session_id):
+    """The session with this id, or a new one when the id is missing or unknown"""
+    study_session = db.session.get(StudySession, session_id) if session_id else None
+    if study_session is None:
+        study_session = StudySession(id=uuid.uuid4().hex)
+        db.session.add(study_session)
+    return study_session
+
+def find_study_session(session_id):
+    """Session by primary key, or None. Never guesses: another user's newest session is not ours"""
+    if not isinstance(session_id, str) or not session_id:
+        return None
+    return db.session.get(StudySession, session_id)
+
+_pixel_cache = None
+_pixel_cache_lock = threading.Lock()
+
+def get_pixel_cache():
+    """Decoded-pixel cache for this process; every process shares the same folder"""
+    global _pixel_cache
+    with _pixel_cache_lock:
+        if _pixel_cache is None:
+            _pixel_cache = PixelCache(app.config['PIXEL_CACHE_FOLDER'], app.config['PIXEL_CACHE_MAX_BYTES'])
+        return _pixel_cache
+
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+
+def get_upload_pool():
+    """Shared pool for per-file upload work, so concurrency stays bounded across requests"""
+    global _upload_pool
+    with _upload_pool_lock:
+        if _upload_pool is None:
+            workers = app.config['UPLOAD_WORKERS']
+            if app.config['UPLOAD_POOL'] == 'process':
+                _upload_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, initializer=telemetry.configure,
+                    initargs=(app.config['METRICS_FOLDER'], app.config['METRICS_FLUSH_INTERVAL']))
+            else:
+                _upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        return _upload_pool
+
+def inference_cache_key(content_hashes):
+    """Cache key for a set of views: order-independent and tied to the model version"""
+    key_source = app.config['MIRAI_MODEL_VERSION'] + ':' + ','.join(sorted(content_hashes))
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+def get_cached_predictions(cache_key):
+    entry = InferenceCache.query.filter_by(cache_key=cache_key).first()
+    if entry is None:
+        return None
+    max_age = timedelta(days=app.config['INFERENCE_CACHE_MAX_AGE_DAYS'])
+    if entry.created_at < datetime.now() - max_age:
+        db.session.delete(entry)
+        db.session.commit()
+        return None
+    predictions = json.loads(entry.predictions)
+    try:
+        entry.hits = (entry.hits or 0) + 1
+        entry.last_used = datetime.now()
+        db.session.commit()
+    except SQLAlchemyError as e:
+        # Only the usage counters are lost; the cached predictions are still good
+        db.session.rollback()
+        telemetry.log.warning(f"Could not update cache entry {cache_key}: {e}")
+    return predictions
+
+def store_cached_predictions(cache_key, content_hashes, predictions):
+    """Insert or refresh the entry in one statement, so identical jobs finishing together both succeed"""
+    now = datetime.now()
+    fields = {
+        'model_version': app.config['MIRAI_MODEL_VERSION'],
+        'content_hashes': ','.join(sorted(content_hashes)),
+        'predictions': json.dumps(predictions),
+        'created_at': now,
+        'last_used': now,
+    }
+    db.session.execute(sqlite_insert(InferenceCache).values(cache_key=cache_key, hits=0, **fields)
+                       .on_conflict_do_update(index_elements=['cache_key'], set_=fields))
+    db.session.commit()
+    evict_cached_predictions()
+
+def save_predictions(cache_key, content_hashes, predictions, cached=False):
+    """Record the risk (and cache new predictions); the prediction stands even if these writes fail"""
+    try:
+        if not cached:
+            store_cached_predictions(cache_key, content_hashes, predictions)
+        record_risk(content_hashes, predictions)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        telemetry.log.warning(f"Could not save predictions for {cache_key}: {e}")
+
+def evict_cached_predictions():
+    """Drop entries past the max age, then the least recently used ones over the size limit"""
+    cutoff = datetime.now() - timedelta(days=app.config['INFERENCE_CACHE_MAX_AGE_DAYS'])
+    InferenceCache.query.filter(InferenceCache.created_at < cutoff).delete()
+
+    overflow = InferenceCache.query.count() - app.config['INFERENCE_CACHE_MAX_ENTRIES']
+    if overflow > 0:
+        oldest = db.session.query(InferenceCache.id).order_by(InferenceCache.last_used).limit(overflow)
+        InferenceCache.query.filter(InferenceCache.id.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+    db.session.commit()
+
+def run_inference(files_to_process_paths, model_client=None):
+    """Send the given DICOM files to the Mirai container, or answer from the cache.
+
+    Returns the JSON-serialisable payload the viewer expects
+    (success, message, target_response, cache) or an error payload.
+    model_client defaults to the shared one.
+    """
+    parsed_files = [get_parsed(filepath) for filepath in files_to_process_paths]
+    try:
+        content_hashes = [parsed.content_hash for parsed in parsed_files]
+    except IOError as e:
+        telemetry.log.warning(f"Error hashing files for processing: {e}")
+        return {'success': False, 'error': 'Failed to read DICOM files for processing.'}
+
+    cache_key = inference_cache_key(content_hashes)
+    cached_predictions = get_cached_predictions(cache_key)
+    if cached_predictions is not None:
+        save_predictions(cache_key, content_hashes, cached_predictions, cached=True)
+        return {
+            'success': True,
+            'message': f'Returned cached predictions for {len(files_to_process_paths)} DICOM files.',
+            'target_response': {'data': {'predictions': cached_predictions}},
+            'cache': 'hit'
+        }
+
+    try:
+        # Uploads the storage GC has deflated are sent uncompressed
+        with inflated_paths([parsed.path for parsed in parsed_files]) as paths:
+            response = (model_client or get_model_client()).post_files(paths, data={'data': '{}'})
+        response.raise_for_status()
+
+        result_data = response.json()
+
+        data_section = result_data.get('data') if isinstance(result_data, dict) else None
+        predictions = data_section.get('predictions') if isinstance(data_section, dict) else None
+        if isinstance(predictions, list):
+            save_predictions(cache_key, content_hashes, predictions)
+
+        return {
+            'success': True,
+            'message': f'Successfully sent {len(files_to_process_paths)} DICOM files to Docker app.',
+            'target_response': result_data,
+            'cache': 'miss'
+        }
+    except requests.exceptions.RequestException as e:
+        return {
+            'success': False,
+            'error': f'Failed to send files to Docker app or receive valid response: {str(e)}',
+            'details': e.response.text if e.response is not None else 'No detailed response'
+        }
+    except IOError as e:
+        telemetry.log.warning(f"Error opening files for processing: {e}")
+        return {'success': False, 'error': f'Failed to open file {os.path.basename(e.filename or "")} for processing.'}
+    except Exception as e:
+        db.session.rollback()
+        return {
+            'success': False,
+            'error': f'An unexpected error occurred during processing: {str(e)}'
+        }
+
+_model_client = None
+_model_client_lock = threading.Lock()
+
+def build_model_client(pool_size):
+    """Client for the Mirai container(s) from MIRAI_* config, keeping up to pool_size connections per endpoint"""
+    return ModelClient(
+        app.config['MIRAI_ENDPOINTS'],
+        connect_timeout=app.config['MIRAI_CONNECT_TIMEOUT'],
+        read_timeout=app.config['MIRAI_READ_TIMEOUT'],
+        retries=app.config['MIRAI_RETRIES'],
+        backoff=app.config['MIRAI_RETRY_BACKOFF'],
+        failure_threshold=app.config['MIRAI_FAILURE_THRESHOLD'],
+        reset_timeout=app.config['MIRAI_RESET_TIMEOUT'],
+        pool_size=pool_size,
+    )
+
+def get_model_client():
+    """Shared pooled client for the inference workers"""
+    global _model_client
+    with _model_client_lock:
+        if _model_client is None:
+            _model_client = build_model_client(app.config['INFERENCE_WORKERS'])
+        return _model_client
+
+def job_to_dict(job):
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'created_at': job.created_at.strftime("%Y-%m-%d %H:%M:%S") if job.created_at else None,
+        'started_at': job.started_at.strftime("%Y-%m-%d %H:%M:%S") if job.started_at else None,
+        'finished_at': job.finished_at.strftime("%Y-%m-%d %H:%M:%S") if job.finished_at else None,
+        'result': json.loads(job.result) if job.result else None
+    }
+
+def finish_inference_job(job, result, status):
+    job.result = json.dumps(result)
+    job.status = status
+    job.finished_at = datetime.now()
+    db.session.commit()
+
+def run_inference_job(job_id):
+    """Job queue handler: run one persisted InferenceJob and store its result"""
+    # Claim the job atomically: with several server processes more than one
+    # queue can hold the same id, and only the first to claim it runs it
+    claimed = db.session.execute(
+        db.update(InferenceJob).where(InferenceJob.id == job_id, InferenceJob.status == JOB_QUEUED)
+        .values(status=JOB_RUNNING, started_at=datetime.now())
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+    job = db.session.get(InferenceJob, job_id)
+
+    with telemetry.trace(job_id) as trace:
+        try:
+            result = run_inference(json.loads(job.file_paths))
+        except Exception as e:
+            db.session.rollback()
+            result = {'success': False, 'error': f'An unexpected error occurred during processing: {str(e)}'}
+
+        try:
+            finish_inference_job(job, result, JOB_DONE if result.get('success') else JOB_FAILED)
+        except SQLAlchemyError as e:
+            # The result could not be stored; record the failure in a fresh transaction
+            # so the job does not stay RUNNING until its lease runs out
+            db.session.rollback()
+            job = db.session.get(InferenceJob, job_id)
+            result = {'success': False, 'error': f'Failed to store the inference result: {str(e)}'}
+            finish_inference_job(job, result, JOB_FAILED)
+        telemetry.log.info('inference job finished', extra={'fields': {
+            'job_id': job_id, 'status': job.status, 'cache': result.get('cache'),
+            'duration_ms': round((job.finished_at - job.started_at).total_seconds() * 1000, 1),
+            'spans': telemetry.span_summary(trace.spans)}})
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Start the inference workers on first use, pick up jobs nobody holds and keep checking for them"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(app, run_inference_job, workers=app.config['INFERENCE_WORKERS'], name='inference').start()
+            recover_jobs(_job_queue)
+            threading.Thread(target=recover_jobs_loop, args=(_job_queue,), name='job-recovery', daemon=True).start()
+        return _job_queue
+
+def recover_jobs(job_queue):
+    """Run the jobs no process is working on: queued ones (e.g. handed back by an exiting
+    worker) and running ones past JOB_LEASE (their worker was killed)"""
+    with app.app_context():
+        expired = datetime.now() - timedelta(seconds=app.config['JOB_LEASE'])
+        for model in (InferenceJob, ReportJob):
+            db.session.execute(db.update(model).where(model.status == JOB_RUNNING, model.started_at < expired)
+                               .values(status=JOB_QUEUED))
+        db.session.commit()
+        # Claims are atomic, so a job another process picks up at the same time still runs once
+        queued = db.session.query(InferenceJob.id).filter(InferenceJob.status == JOB_QUEUED) \
+            .order_by(InferenceJob.created_at)
+        for (job_id,) in queued:
+            job_queue.submit(job_id)
+        for job in ReportJob.query.filter(ReportJob.status == JOB_QUEUED).order_by(ReportJob.created_at).all():
+            run_report_job(job)
+        db.session.remove()
+
+def recover_jobs_loop(job_queue):
+    while True:
+        time.sleep(app.config['JOB_RECOVERY_INTERVAL'])
+        try:
+            recover_jobs(job_queue)
+        except Exception as e:
+            telemetry.log.warning(f'Job recovery failed: {e}')
+
+def drain_jobs(timeout):
+    """For an exiting worker: give running inference jobs up to timeout seconds to finish and
+    queue the rest again, so another worker runs them instead of clients polling forever"""
+    with _job_queue_lock:
+        job_queue = _job_queue
+    if job_queue is None:
+        return
+    unfinished = job_queue.drain(timeout)
+    if unfinished:
+        with app.app_context():
+            db.session.execute(db.update(InferenceJob)
+                               .where(InferenceJob.id.in_(unfinished), InferenceJob.status == JOB_RUNNING)
+                               .values(status=JOB_QUEUED))
+            db.session.commit()
+            db.session.remove()
+        telemetry.log.info(f'Handed {len(unfinished)} unfinished inference job(s) back to the queue')
+
+def report_sources(pdf_study):
+    """Paths of a PDFStudy's two source PDFs, or an error message if one is missing"""
+    paths = [os.path.join(app.config['ARCHIVES_FOLDER'], name)
+             for name in (pdf_study.filename_1, pdf_study.filename_2)]
+    for number, path in enumerate(paths, 1):
+        if not os.path.exists(path):
+            return None, f'Source PDF {number} not found: {os.path.basename(path)}'
+    return paths, None
+
+def submit_report(pdf_study, sources, percentage, risk_message):
+    """Render one report on the process pool; returns the future of (filename, cached)"""
+    args = (build_report, pdf_study.id, pdf_study.study_name, sources, percentage, risk_message,
+            os.path.abspath(app.config['REPORTS_FOLDER']), os.path.abspath(app.config['REPORT_CACHE_FOLDER']))
+    pool = get_report_pool()
+    try:
+        future = pool.submit(*args)
+    except BrokenProcessPool:
+        # A worker died earlier (e.g. killed by the OOM killer): start over with a new pool
+        discard_report_pool(pool)
+        pool = get_report_pool()
+        future = pool.submit(*args)
+    # A worker dying while rendering this report breaks the pool for every later one too
+    future.add_done_callback(
+        lambda f, pool=pool: discard_report_pool(pool) if isinstance(f.exception(), BrokenProcessPool) else None)
+    return future
+
+def finish_report_job(job_id, future):
+    """Done-callback of a report future: store the outcome on its ReportJob"""
+    with app.app_context():
+        job = db.session.get(ReportJob, job_id)
+        if job is None:
+            return
+        try:
+            filename, cached = future.result()
+            result = {'success': True, 'report_url': f'/reports/{filename}', 'cached': cached}
+        except Exception as e:
+            telemetry.log.warning(f"Error generating report PDF: {str(e)}", extra={'fields': {'job_id': job_id}})
+            result = {'success': False, 'error': f'Error generating report PDF: {str(e)}'}
+        job.result = json.dumps(result)
+        job.status = JOB_DONE if result['success'] else JOB_FAILED
+        job.finished_at = datetime.now()
+        db.session.commit()
+
+def run_report_job(job):
+    """Claim a queued ReportJob and hand it to the process pool"""
+    claimed = db.session.execute(
+        db.update(ReportJob).where(ReportJob.id == job.id, ReportJob.status == JOB_QUEUED)
+        .values(status=JOB_RUNNING, started_at=datetime.now())
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+    db.session.refresh(job)
+
+    pdf_study = db.session.get(PDFStudy, job.pdf_study_id)
+    sources, error = report_sources(pdf_study) if pdf_study else (None, 'PDF study not found.')
+    if error:
+        job.status = JOB_FAILED
+        job.result = json.dumps({'success': False, 'error': error})
+        job.finished_at = datetime.now()
+        db.session.commit()
+        return
+    try:
+        future = submit_report(pdf_study, sources, job.percentage, job.risk_message)
+    except Exception as e:
+        # Otherwise the job would stay RUNNING and every client asking for this report would wait on it forever
+        job.status = JOB_FAILED
+        job.result = json.dumps({'success': False, 'error': f'Error generating report PDF: {str(e)}'})
+        job.finished_at = datetime.now()
+        db.session.commit()
+        return
+    future.add_done_callback(lambda f, job_id=job.id: finish_report_job(job_id, f))
+
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+def get_report_pool():
+    """Process pool for PDF rendering (CPU-bound, so threads would serialize on the GIL)"""
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is None:
+            _report_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=app.config['REPORT_WORKERS'], initializer=telemetry.configure,
+                initargs=(app.config['METRICS_FOLDER'], app.config['METRICS_FLUSH_INTERVAL']))
+        return _report_pool
+
+def discard_report_pool(pool):
+    """Drop a broken report pool, so the next get_report_pool() starts a new one"""
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is not pool:
+            return
+        _report_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def storage_references():
+    """What the database still points at, for the storage GC"""
+    with app.app_context():
+        uploads = {name for (name,) in db.session.query(StudyFile.stored_filename)}
+        uploads.update(name for (name,) in db.session.query(DicomIndex.stored_filename))
+        pending = db.session.query(InferenceJob.file_paths).filter(InferenceJob.status.in_([JOB_QUEUED, JOB_RUNNING]))
+        for (file_paths,) in pending:
+            uploads.update(os.path.basename(path) for path in json.loads(file_paths))
+        archives = set()
+        report_sources = set()
+        for study_id, filename_1, filename_2 in db.session.query(PDFStudy.id, PDFStudy.filename_1, PDFStudy.filename_2):
+            archives.update((filename_1, filename_2))
+            report_sources.add(study_id)
+        previews = {os.path.splitext(name)[0] for (name,) in db.session.query(StudyFile.preview) if name}
+        images = {content_hash for (content_hash,) in db.session.query(StudyFile.content_hash)}
+        db.session.remove()
+    return {'uploads': uploads, 'archives': archives, 'previews': previews,
+            'report_sources': report_sources, 'images': images}
+
+_storage_gc = None
+_storage_gc_lock = threading.Lock()
+
+def get_storage_gc():
+    """Storage lifecycle manager for this process; passes are serialized across processes by a lock file"""
+    global _storage_gc
+    with _storage_gc_lock:
+        if _storage_gc is None:
+            folders = {kind: app.config[key] for kind, key in (
+                ('uploads', 'UPLOAD_FOLDER'), ('archives', 'ARCHIVES_FOLDER'), ('previews', 'PREVIEW_FOLDER'),
+                ('reports', 'REPORTS_FOLDER'), ('report_cache', 'REPORT_CACHE_FOLDER'),
+                ('tile_cache', 'TILE_CACHE_FOLDER'))}
+            _storage_gc = StorageGC(
+                folders, storage_references,
+                grace=app.config['STORAGE_ORPHAN_GRACE'],
+                report_retention_days=app.config['REPORT_RETENTION_DAYS'],
+                tile_retention_days=app.config['TILE_CACHE_RETENTION_DAYS'],
+                compression=app.config['DICOM_COMPRESSION'],
+                compress_after_days=app.config['DICOM_COMPRESS_AFTER_DAYS'],
+                batch=app.config['STORAGE_GC_BATCH'],
+            )
+            if app.config['STORAGE_GC_INTERVAL']:
+                _storage_gc.start(app.config['STORAGE_GC_INTERVAL'])
+        return _storage_gc
+
 # --- Routes ---
 
+@app.before_request
+def begin_trace():
+    """Trace id (the client's X-Request-ID when valid), request timer and optional profiler"""
+    g.trace_token = telemetry.start_trace(request.headers.get('X-Request-ID'))
+    g.request_started = time.perf_counter()
+    profile = request.headers.get('X-Profile')
+    if profile and app.config['PROFILING_ENABLED']:
+        g.profile = telemetry.start_profile(profile.strip().lower())
+
+@app.after_request
+def finish_trace(response):
+    trace = telemetry.current_trace()
+    if trace is None or 'request_started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    telemetry.observe(telemetry.REQUEST_METRIC,
+                      {'method': request.method, 'route': route, 'status': response.status_code}, elapsed)
+    response.headers['X-Request-ID'] = trace.id
+    if g.get('profile'):
+        response.headers['X-Profile'] = telemetry.stop_profile(g.pop('profile'), app.config['PROFILE_FOLDER'], trace.id)
+    if app.config['LOG_REQUESTS']:
+        telemetry.log.info(f'{request.method} {request.path} {response.status_code}', extra={'fields': {
+            'method': request.method, 'path': request.path, 'route': route, 'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 1), 'spans': telemetry.span_summary(trace.spans)}})
+    return response
+
+@app.teardown_request
+def end_trace(exc):
+    profile = g.pop('profile', None)
+    if profile:
+        # finish_trace did not run, e.g. a before_request handler failed
+        telemetry.stop_profile(profile, app.config['PROFILE_FOLDER'], telemetry.current_trace().id)
+    token = g.pop('trace_token', None)
+    if token is not None:
+        telemetry.end_trace(token)
+
+@app.before_request
+def start_job_queue():
+    init_storage()
+    get_job_queue()
+    get_storage_gc()
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return jsonify({'success': False, 'error': e.description}), 400
+
+def paginate_pdf_studies():
+    """Newest PDF studies first, one page at a time (?page=, ?per_page=)"""
+    return db.paginate(db.select(PDFStudy).order_by(PDFStudy.upload_date.desc(), PDFStudy.id.desc()),
+                       per_page=request.args.get('per_page', app.config['LIST_PER_PAGE'], type=int),
+                       max_per_page=app.config['LIST_MAX_PER_PAGE'],
+                       error_out=False)
+
 @app.route('/')
 def index():
-    studies = PDFStudy.query.all()
-    return render_template('login.html', studies=studies)
+    return render_template('login.html', studies=paginate_pdf_studies())
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'file' not in request.files:
+    # Parsing the form is what streams every part to disk
+    with telemetry.span('upload_save'):
+        files = request.files.getlist('file')
+    if not files:
         return jsonify({'success': False, 'error': 'No file part'})
 
-    files = request.files.getlist('file')
     uploaded_files = []
     errors = []
     previews = []
     all_metadata = []
 
+    # Files were already streamed to disk while the body was parsed; here they
+    # are committed to their content-addressed name and then parsed and
+    # previewed on the upload pool. entries keeps one item per input file so the
+    # response arrays come out in input order.
+    pool = get_upload_pool()
+    entries = []
+
     for file in files:
         if file.filename == '':
-            errors.append('Empty file name')
+            entries.append({'error': 'Empty file name'})
             continue
 
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            dicom_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             try:
-                file.save(dicom_path)
+                dicom_path, content_hash = file.stream.commit()
+                # Previews are named after the content too, so a re-uploaded file reuses them
+                preview_filename = f"{content_hash}.png"
+                preview_path = os.path.join(app.config['PREVIEW_FOLDER'], preview_filename)
+                future = pool.submit(process_upload, dicom_path, content_hash, preview_path)
+                entries.append({'filename': filename, 'dicom_path': dicom_path, 'content_hash': content_hash,
+                                'preview': preview_filename, 'future': future})
+            except UploadRejected as e:
+                entries.append({'filename': filename, 'error': e.description})
+            except Exception as e:
+                entries.append({'filename': filename, 'error': f'Failed to save or process {filename}: {str(e)}'})
 
-                metadata_for_file = extract_dicom_metadata(dicom_path)
-                all_metadata.append(metadata_for_file)
+        else:
+            entries.append({'error': f'Invalid file type: {file.filename}'})
+
+    for entry in entries:
+        if 'future' not in entry:
+            # Rejected parts keep their slot, so previews and metadata stay aligned with the input files
+            errors.append(entry['error'])
+            previews.append(None)
+            all_metadata.append(None)
+            continue
 
-                preview_id = str(uuid.uuid4())
-                preview_filename = f"{preview_id}.png"
-                preview_path = os.path.join(app.config['PREVIEW_FOLDER'], preview_filename)
+        filename = entry['filename']
+        try:
+            metadata_for_file, preview_ok, entry['index_fields'], spans = \
+                entry['future'].result(timeout=app.config['UPLOAD_TIMEOUT'])
+            telemetry.add_spans(spans)
+        except concurrent.futures.TimeoutError:
+            entry['future'].cancel()
+            errors.append(f'Timed out processing {filename}')
+            previews.append(None)
+            all_metadata.append(None)
+            continue
+        except Exception as e:
+            errors.append(f'Failed to save or process {filename}: {str(e)}')
+            previews.append(None)
+            all_metadata.append(None)
+            continue
 
-                if generate_preview(dicom_path, preview_path):
-                    previews.append(preview_filename)
-                    uploaded_files.append(filename)
-                else:
-                    errors.append(f'Preview failed for {filename}')
-                    previews.append(None)
-            except Exception as e:
-                errors.append(f'Failed to save or process {filename}: {str(e)}')
-                previews.append(None)
+        # Keep the content hash for the inference stage
+        remember(ParsedDicom(entry['dicom_path'], entry['content_hash']))
+        all_metadata.append(metadata_for_file)
 
+        if preview_ok:
+            previews.append(entry['preview'])
+            uploaded_files.append(filename)
+            entry['metadata'] = metadata_for_file
         else:
-            errors.append(f'Invalid file type: {file.filename}')
+            errors.append(f'Preview failed for {filename}')
+            previews.append(None)
 
     if len(errors) > 0 and len(uploaded_files) == 0:
         return jsonify({'success': False, 'error': ', '.join(errors)})
 
+    # Record the files in the study session so inference and reports can find
+    # them by id instead of scanning the upload folder
+    study_session = get_or_create_study_session(request.form.get('study_session_id'))
+    position = len(study_session.files)
+    for entry in entries:
+        if 'metadata' not in entry:
+            continue
+        db.session.add(StudyFile(
+            study_session_id=study_session.id,
+            position=position,
+            original_filename=entry['filename'],
+            stored_filename=os.path.basename(entry['dicom_path']),
+            content_hash=entry['content_hash'],
+            preview=entry['preview'],
+            dicom_metadata=json.dumps(entry['metadata'])
+        ))
+        if entry['index_fields']:
+            index_dicom_file(os.path.basename(entry['dicom_path']), entry['content_hash'], entry['index_fields'],
+                             os.path.getsize(entry['dicom_path']))
+        position += 1
+    db.session.commit()
+
+    # Tile base URLs for the zoomable viewer, aligned with previews
+    tiles = [f"/tiles/{study_session.id}/{entry['content_hash']}" if 'metadata' in entry else None
+             for entry in entries]
+
     return jsonify({
         'success': True,
+        'study_session_id': study_session.id,
         'uploaded_files': uploaded_files,
         'previews': previews,
+        'tiles': tiles,
         'errors': errors,
         'metadata': all_metadata
     })
 
 @app.route('/upload_pdf', methods=['POST'])
 def upload_pdf():
-    pdf1 = request.files.get('pdf1')
-    pdf2 = request.files.get('pdf2')
+    with telemetry.span('upload_save'):
+        pdf1 = request.files.get('pdf1')
+        pdf2 = request.files.get('pdf2')
 
     if not pdf1 or not pdf2:
         return jsonify({'success': False, 'error': 'Se requieren dos archivos PDF'})
@@ -211,16 +1092,12 @@ def upload_pdf():
     study_name = f"Estudio_{timestamp}_{study_id}"
 
     if pdf1.filename.lower().endswith('.pdf') and pdf2.filename.lower().endswith('.pdf'):
-        # Using secure_filename for PDF filenames as well for consistency and security
-        filename_1 = secure_filename(f"{study_name}_1.pdf")
-        filename_2 = secure_filename(f"{study_name}_2.pdf")
-
-        path_1 = os.path.join(app.config['ARCHIVES_FOLDER'], filename_1)
-        path_2 = os.path.join(app.config['ARCHIVES_FOLDER'], filename_2)
-
         try:
-            pdf1.save(path_1)
-            pdf2.save(path_2)
+            # Both PDFs were streamed into ARCHIVES_FOLDER; store them as <sha256>.pdf
+            path_1, _ = pdf1.stream.commit()
+            path_2, _ = pdf2.stream.commit()
+            filename_1 = os.path.basename(path_1)
+            filename_2 = os.path.basename(path_2)
 
             new_pdf = PDFStudy(
                 study_name=study_name,
@@ -229,9 +1106,20 @@ def upload_pdf():
                 upload_date=datetime.now() # NEW: Save upload date for easy retrieval
             )
             db.session.add(new_pdf)
+            db.session.flush()
+
+            study_session = get_or_create_study_session(request.form.get('study_session_id'))
+            if study_session.pdf_study_id is not None:
+                # Like a new set of DICOMs, another pair of PDFs starts a new session
+                # instead of replacing the PDFs the current one is reported with
+                study_session = get_or_create_study_session(None)
+            study_session.pdf_study_id = new_pdf.id
             db.session.commit()
 
-            return jsonify({'success': True, 'message': 'Archivos subidos correctamente', 'study_id': new_pdf.id})
+            return jsonify({'success': True, 'message': 'Archivos subidos correctamente', 'study_id': new_pdf.id,
+                            'study_session_id': study_session.id})
+        except UploadRejected:
+            raise
         except Exception as e:
             db.session.rollback()
             return jsonify({'success': False, 'error': f'Failed to save PDF files: {str(e)}'})
@@ -240,55 +1128,69 @@ def upload_pdf():
 
 @app.route('/process_recent_dicoms', methods=['POST'])
 def process_recent_dicoms():
-    dicom_files_in_folder = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        if allowed_file(filename):
-            full_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.isfile(full_path):
-                dicom_files_in_folder.append((full_path, os.path.getmtime(full_path)))
-
-    dicom_files_in_folder.sort(key=lambda x: x[1], reverse=True)
-    files_to_process_paths = [path for path, _ in dicom_files_in_folder[:4]]
-
-    if not files_to_process_paths:
-        return jsonify({'success': False, 'error': 'No DICOM files found in the upload folder to process.'})
-
-    target_url = "http://localhost:5000/dicom/files"
-
-    files_payload = []
-    for filepath in files_to_process_paths:
-        try:
-            files_payload.append(('dicom', (os.path.basename(filepath), open(filepath, 'rb'), 'application/dicom')))
-        except IOError as e:
-            print(f"Error opening file {filepath}: {e}")
-            return jsonify({'success': False, 'error': f'Failed to open file {os.path.basename(filepath)} for processing.'})
-
-    try:
-        response = requests.post(target_url, files=files_payload, data={'data': '{}'})
-        response.raise_for_status()
-
-        result_data = response.json()
-
-        return jsonify({
-            'success': True,
-            'message': f'Successfully sent {len(files_to_process_paths)} DICOM files to Docker app.',
-            'target_response': result_data
-        })
-    except requests.exceptions.RequestException as e:
-        return jsonify({
-            'success': False,
-            'error': f'Failed to send files to Docker app or receive valid response: {str(e)}',
-            'details': e.response.text if hasattr(e, 'response') else 'No detailed response'
-        })
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'An unexpected error occurred during processing: {str(e)}'
-        })
-    finally:
-        for _, (filename, file_obj, mime_type) in files_payload:
-            if not file_obj.closed:
-                file_obj.close()
+    data = request.get_json(silent=True) or {}
+    if not data.get('study_session_id'):
+        return jsonify({'success': False, 'error': 'Missing study_session_id. Please upload DICOM files first.'}), 400
+    study_session = find_study_session(data['study_session_id'])
+    if study_session is None:
+        return jsonify({'success': False, 'error': 'Study session not found. Please upload DICOM files first.'}), 404
+
+    study_files = study_session.files
+    if not study_files:
+        return jsonify({'success': False, 'error': 'No DICOM files found in this study session to process.'})
+
+    files_to_process_paths = []
+    for study_file in study_files:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], study_file.stored_filename)
+        remember(ParsedDicom(path, study_file.content_hash))
+        files_to_process_paths.append(path)
+
+    # Inference runs on the job queue; the client polls /jobs/<id> for the result
+    job = InferenceJob(id=uuid.uuid4().hex, status=JOB_QUEUED, file_paths=json.dumps(files_to_process_paths))
+    db.session.add(job)
+    db.session.commit()
+    get_job_queue().submit(job.id)
+
+    return jsonify({'success': True, 'job_id': job.id, 'status': job.status, 'status_url': f'/jobs/{job.id}',
+                    'study_session_id': study_session.id}), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = db.session.get(InferenceJob, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job_to_dict(job)})
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = db.session.get(InferenceJob, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    if job.status not in FINISHED_STATES:
+        return jsonify({'success': False, 'status': job.status, 'error': 'Job has not finished yet'}), 202
+    return jsonify(json.loads(job.result))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events with the job status until it finishes"""
+    if db.session.get(InferenceJob, job_id) is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    @stream_with_context
+    def events():
+        last_status = None
+        while True:
+            db.session.expire_all()
+            job = db.session.get(InferenceJob, job_id)
+            if job.status != last_status:
+                last_status = job.status
+                yield f"data: {json.dumps(job_to_dict(job))}\n\n"
+            if job.status in FINISHED_STATES:
+                return
+            time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/generate_report_pdf', methods=['POST'])
@@ -296,104 +1198,111 @@ def generate_report_pdf():
     data = request.get_json()
     if not data or 'percentage' not in data or 'riskMessage' not in data:
         return jsonify({'success': False, 'error': 'Missing percentage or riskMessage in request.'}), 400
+    if not data.get('study_session_id'):
+        return jsonify({'success': False, 'error': 'Missing study_session_id. Please upload the study files first.'}), 400
 
     percentage = data['percentage']
     risk_message = data['riskMessage']
 
     try:
-        # 1. Retrieve the most recent PDFStudy entry
-        # This assumes the user processes DICOMs and then wants a report using the most recently uploaded PDFs.
-        last_pdf_study = PDFStudy.query.order_by(PDFStudy.upload_date.desc()).first()
+        # 1. Retrieve the PDFStudy linked to the study session
+        study_session = find_study_session(data['study_session_id'])
+        if study_session is None:
+            return jsonify({'success': False, 'error': 'Study session not found.'}), 404
+        last_pdf_study = study_session.pdf_study
         if not last_pdf_study:
             return jsonify({'success': False, 'error': 'No PDF studies found to merge. Please upload PDFs first.'}), 404
 
-        pdf1_path = os.path.join(app.config['ARCHIVES_FOLDER'], last_pdf_study.filename_1)
-        pdf2_path = os.path.join(app.config['ARCHIVES_FOLDER'], last_pdf_study.filename_2)
-
-        if not os.path.exists(pdf1_path):
-            return jsonify({'success': False, 'error': f'Source PDF 1 not found: {last_pdf_study.filename_1}'}), 404
-        if not os.path.exists(pdf2_path):
-            return jsonify({'success': False, 'error': f'Source PDF 2 not found: {last_pdf_study.filename_2}'}), 404
-
-        # 2. Initialize PDF Merger (pypdf)
-        pdf_writer = PdfWriter()
-
-        # 3. Add pages from PDF 1
-        with open(pdf1_path, 'rb') as f1:
-            pdf1_reader = PdfReader(f1)
-            for page_num in range(len(pdf1_reader.pages)):
-                pdf_writer.add_page(pdf1_reader.pages[page_num])
-
-        # 4. Add pages from PDF 2
-        with open(pdf2_path, 'rb') as f2:
-            pdf2_reader = PdfReader(f2)
-            for page_num in range(len(pdf2_reader.pages)):
-                pdf_writer.add_page(pdf2_reader.pages[page_num])
-
-        # 5. Generate the new page with ReportLab
-        # Create an in-memory buffer to build the ReportLab PDF
-        buffer = BytesIO()
-        # Use letter size for the new page
-        doc = SimpleDocTemplate(buffer, pagesize=letter)
-        styles = getSampleStyleSheet()
-        story = []
-
-        # Add title
-        title_style = styles['h1']
-        title_style.alignment = TA_CENTER
-        story.append(Paragraph("Reporte de Análisis DICOM", title_style))
-        story.append(Spacer(1, 0.2 * inch))
-
-        # Add prediction result
-        prediction_style = styles['Normal']
-        prediction_style.fontSize = 18
-        prediction_style.leading = 22 # Line height
-        prediction_style.alignment = TA_CENTER
-        story.append(Paragraph(f"Predicción: <font color='blue'><b>{percentage}%</b></font>", prediction_style))
-        story.append(Spacer(1, 0.2 * inch))
-
-        # Add risk message
-        risk_style = styles['Normal']
-        risk_style.fontSize = 24
-        risk_style.leading = 30
-        risk_style.alignment = TA_CENTER
-        risk_color = 'red' if risk_message == 'ALTO RIESGO' else 'green'
-        story.append(Paragraph(f"<font color='{risk_color}'><b>{risk_message}</b></font>", risk_style))
-        story.append(Spacer(1, 0.5 * inch))
-
-        # Add some explanatory text
-        normal_style = styles['Normal']
-        normal_style.alignment = TA_CENTER
-        story.append(Paragraph("Este informe ha sido generado automáticamente basándose en los resultados del procesamiento de las imágenes DICOM.", normal_style))
-        story.append(Spacer(1, 0.2 * inch))
-        story.append(Paragraph(f"Estudio original: {last_pdf_study.study_name}", normal_style))
-        story.append(Spacer(1, 0.2 * inch))
-        story.append(Paragraph(f"Fecha de generación del reporte: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", normal_style))
-
-        doc.build(story) # Build the ReportLab PDF
-        buffer.seek(0) # Rewind the buffer to the beginning
-
-        # Add the ReportLab-generated PDF (from memory) to the main PDF writer
-        reportlab_pdf_reader = PdfReader(buffer)
-        for page_num in range(len(reportlab_pdf_reader.pages)):
-            pdf_writer.add_page(reportlab_pdf_reader.pages[page_num])
-
-        # 6. Save the final merged PDF
-        report_filename = f"Reporte_{uuid.uuid4().hex}.pdf" # Unique filename for the report
-        report_path = os.path.join(app.config['REPORTS_FOLDER'], report_filename)
-
-        with open(report_path, 'wb') as output_pdf:
-            pdf_writer.write(output_pdf)
-
-        # 7. Return the URL to the generated PDF
-        report_url = f"/static/reports/{report_filename}"
-        return jsonify({'success': True, 'report_url': report_url})
+        # 2. Reuse the report for this study and result if it was already rendered
+        report_name = report_filename(last_pdf_study.id, percentage, risk_message)
+        if os.path.exists(os.path.join(app.config['REPORTS_FOLDER'], report_name)):
+            return jsonify({'success': True, 'report_url': f'/reports/{report_name}', 'cached': True})
+
+        # 3. Otherwise render it on the process pool; the client polls /reports/jobs/<id>.
+        # A job already rendering the same report is shared instead of duplicated.
+        job = ReportJob.query.filter(ReportJob.report_filename == report_name,
+                                     ReportJob.status.in_([JOB_QUEUED, JOB_RUNNING])).first()
+        if job is None:
+            job = ReportJob(id=uuid.uuid4().hex, status=JOB_QUEUED, pdf_study_id=last_pdf_study.id,
+                            percentage=str(percentage), risk_message=risk_message, report_filename=report_name)
+            db.session.add(job)
+            db.session.commit()
+            run_report_job(job)
+
+        return jsonify({'success': True, 'job_id': job.id, 'status': job.status,
+                        'status_url': f'/reports/jobs/{job.id}'}), 202
 
     except Exception as e:
-        print(f"Error generating report PDF: {str(e)}")
+        telemetry.log.exception(f"Error generating report PDF: {str(e)}")
         return jsonify({'success': False, 'error': f'Error generating report PDF: {str(e)}'}), 500
 
 
+@app.route('/reports/jobs/<job_id>')
+def report_job_status(job_id):
+    job = db.session.get(ReportJob, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job_to_dict(job)})
+
+@app.route('/reports/<filename>')
+def download_report(filename):
+    """Finished report, streamed from disk with HTTP range and conditional request support"""
+    return send_from_directory(os.path.abspath(app.config['REPORTS_FOLDER']), filename, mimetype='application/pdf',
+                               conditional=True, max_age=3600)
+
+@app.route('/reports/bulk', methods=['POST'])
+def bulk_reports():
+    """Render reports for many studies across the process pool and stream them back as one ZIP.
+
+    Body: {"reports": [{"study_session_id" or "pdf_study_id", "percentage", "riskMessage"}, ...]}
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('reports')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Expected a non-empty "reports" list.'}), 400
+    if len(items) > app.config['REPORT_BULK_MAX']:
+        return jsonify({'success': False, 'error': f"At most {app.config['REPORT_BULK_MAX']} reports per request."}), 400
+
+    # Validate everything before the first byte of the ZIP is sent
+    tasks = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict) or 'percentage' not in item or 'riskMessage' not in item:
+            return jsonify({'success': False, 'error': f'Report {number}: missing percentage or riskMessage.'}), 400
+        if item.get('pdf_study_id') is not None:
+            pdf_study = db.session.get(PDFStudy, item['pdf_study_id'])
+        else:
+            study_session = db.session.get(StudySession, item.get('study_session_id') or '')
+            pdf_study = study_session.pdf_study if study_session else None
+        if pdf_study is None:
+            return jsonify({'success': False, 'error': f'Report {number}: PDF study not found.'}), 404
+        sources, error = report_sources(pdf_study)
+        if error:
+            return jsonify({'success': False, 'error': f'Report {number}: {error}'}), 404
+        tasks.append((pdf_study, sources, str(item['percentage']), item['riskMessage']))
+
+    futures = {submit_report(pdf_study, sources, percentage, risk_message): number
+               for number, (pdf_study, sources, percentage, risk_message) in enumerate(tasks, 1)}
+    reports_folder = app.config['REPORTS_FOLDER']
+
+    def finished_reports():
+        errors = []
+        added = set()
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                filename, _ = future.result()
+            except Exception as e:
+                errors.append({'report': futures[future], 'error': str(e)})
+                continue
+            if filename not in added:
+                added.add(filename)
+                yield filename, os.path.join(reports_folder, filename)
+        if errors:
+            yield 'errors.json', json.dumps(errors, indent=2).encode('utf-8')
+
+    download_name = f"reportes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(stream_zip(finished_reports()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
 @app.route('/dicom/files', methods=['POST'])
 def receive_dicom_files_internal():
     # This endpoint is designed to simulate your Docker app's behavior if it's
@@ -405,7 +1314,8 @@ def receive_dicom_files_internal():
     files = request.files.getlist('dicom')
     received_filenames = [file.filename for file in files]
 
-    print(f"Flask app's /dicom/files received {len(received_filenames)} files: {received_filenames}")
+    telemetry.log.info(f"Flask app's /dicom/files received {len(received_filenames)} files",
+                       extra={'fields': {'files': received_filenames}})
 
     processed_results = [f"Processed {f}" for f in received_filenames]
 
@@ -417,24 +1327,155 @@ def receive_dicom_files_internal():
     })
 
 
+@app.route('/studies/search')
+def search_studies():
+    """Indexed studies filtered by patient, study date range and risk level, newest first"""
+    patient = request.args.get('patient', '').strip()
+    date_from = request.args.get('date_from', '').replace('-', '')
+    date_to = request.args.get('date_to', '').replace('-', '')
+    risk = request.args.get('risk', '').strip().lower()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), app.config['SEARCH_MAX_PER_PAGE'])
+
+    filters = []
+    if patient:
+        # Name prefix as a range so the patient_name index can be used
+        filters.append(db.or_(
+            DicomIndex.patient_id == patient,
+            db.and_(DicomIndex.patient_name >= patient, DicomIndex.patient_name < patient + '\uffff'),
+        ))
+    if date_from:
+        filters.append(DicomIndex.study_date >= date_from)
+    if date_to:
+        filters.append(DicomIndex.study_date <= date_to)
+    if risk in ('high', 'low'):
+        filters.append(DicomIndex.risk_level == risk)
+
+    # Counting distinct uids only touches ix_dicom_index_date_study, never the table
+    total = db.session.query(db.func.count(db.distinct(DicomIndex.study_instance_uid))) \
+        .filter(*filters).scalar()
+    # All images of a study share its StudyDate, so grouping by (date, uid) lets
+    # SQLite walk the same index in order instead of sorting every group
+    rows = db.session.query(
+        DicomIndex.study_instance_uid,
+        db.func.max(DicomIndex.patient_id),
+        db.func.max(DicomIndex.patient_name),
+        DicomIndex.study_date,
+        db.func.max(DicomIndex.risk_score),
+        db.func.count(DicomIndex.id),
+    ).filter(*filters) \
+        .group_by(DicomIndex.study_date, DicomIndex.study_instance_uid) \
+        .order_by(DicomIndex.study_date.desc(), DicomIndex.study_instance_uid.desc()) \
+        .limit(per_page).offset((page - 1) * per_page).all()
+
+    return jsonify({
+        'success': True,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'studies': [
+            {
+                'study_instance_uid': study_uid,
+                'patient_id': patient_id,
+                'patient_name': patient_name,
+                'study_date': study_date,
+                'risk_score': risk_score,
+                'risk_level': None if risk_score is None else
+                    ('high' if risk_score >= app.config['RISK_THRESHOLD_PERCENT'] else 'low'),
+                'images': images
+            }
+            for study_uid, patient_id, patient_name, study_date, risk_score, images in rows
+        ]
+    })
+
+@app.route('/studies/reindex', methods=['POST'])
+def reindex_studies():
+    started = start_background_indexer()
+    return jsonify({'success': True, 'started': started,
+                    'message': 'Indexing started' if started else 'Indexer already running'}), 202
+
+def find_tile_source(study, image):
+    study_file = StudyFile.query.filter_by(study_session_id=study, content_hash=image).first()
+    if study_file is None:
+        return None
+    dicom_path = os.path.join(app.config['UPLOAD_FOLDER'], study_file.stored_filename)
+    return get_tile_source(dicom_path, study_file.content_hash, app.config['TILE_CACHE_FOLDER'], get_pixel_cache())
+
+@app.route('/tiles/<study>/<image>/info')
+def tile_info(study, image):
+    """Size, zoom levels and initial window/level of an uploaded image"""
+    source = find_tile_source(study, image)
+    if source is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    try:
+        return jsonify({'success': True, **source.info})
+    except Exception as e:
+        telemetry.log.warning(f"Tile pyramid failed for {image}: {str(e)}")
+        return jsonify({'success': False, 'error': f'Could not decode image: {str(e)}'}), 500
+
+@app.route('/tiles/<study>/<image>/<int:z>/<int:x>/<int:y>.png')
+def tile(study, image, z, x, y):
+    """One 256x256 PNG tile; ?level=<center>&window=<width> overrides the DICOM window"""
+    source = find_tile_source(study, image)
+    if source is None:
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    center = request.args.get('level', type=float)
+    width = request.args.get('window', type=float)
+    try:
+        payload = source.tile(z, x, y, center, width)
+    except TileNotFound as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    except Exception as e:
+        telemetry.log.warning(f"Tile pyramid failed for {image}: {str(e)}")
+        return jsonify({'success': False, 'error': f'Could not decode image: {str(e)}'}), 500
+
+    # Tiles are addressed by content hash and window, so they never change
+    response = Response(payload, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: stage and request latency histograms of every process"""
+    return Response(telemetry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles/<filename>')
+def serve_profile(filename):
+    """Profiles saved for X-Profile requests (only while profiling is enabled)"""
+    if not app.config['PROFILING_ENABLED']:
+        return jsonify({'success': False, 'error': 'Profiling is disabled'}), 404
+    return send_from_directory(os.path.abspath(app.config['PROFILE_FOLDER']), filename, as_attachment=True)
+
+@app.route('/storage')
+def storage_stats():
+    """Space per storage folder, savings from deduplication and compression, and the last GC pass"""
+    return jsonify({'success': True, **get_storage_gc().stats()})
+
+@app.route('/cache/pixels')
+def pixel_cache_stats():
+    """Hit/miss counters of this process's pixel cache and the size of the shared folder"""
+    return jsonify({'success': True, **get_pixel_cache().stats()})
+
 @app.route('/previews/<filename>')
 def serve_preview(filename):
-    return send_from_directory(app.config['PREVIEW_FOLDER'], filename)
+    return send_from_directory(os.path.abspath(app.config['PREVIEW_FOLDER']), filename)
 
 @app.route('/uploads/<filename>')
 def serve_dicom(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
 
 # NEW: Route to serve generated reports
 @app.route('/static/reports/<filename>')
 def serve_report(filename):
-    return send_from_directory(app.config['REPORTS_FOLDER'], filename)
+    return send_from_directory(os.path.abspath(app.config['REPORTS_FOLDER']), filename)
 
 
 @app.route('/ver_estudios_pdf')
 def ver_estudios_pdf():
-    estudios = PDFStudy.query.all()
-    return jsonify([
+    estudios = paginate_pdf_studies()
+    response = jsonify([
         {
             'id': e.id,
             'nombre_estudio': e.study_name,
@@ -442,8 +1483,25 @@ def ver_estudios_pdf():
             'archivo_2': e.filename_2,
             'fecha': e.upload_date.strftime("%Y-%m-%d %H:%M:%S") if hasattr(e, 'upload_date') else 'N/A'
         }
-        for e in estudios
+        for e in estudios.items
     ])
+    # The body stays a plain list; paging details go in headers
+    response.headers['X-Total-Count'] = str(estudios.total)
+    response.headers['X-Page'] = str(estudios.page)
+    response.headers['X-Per-Page'] = str(estudios.per_page)
+    return response
+
+_login_limiter = None
+_login_limiter_lock = threading.Lock()
+
+def get_login_limiter():
+    """Failed-login limiter built from LOGIN_RATE_LIMIT_* config"""
+    global _login_limiter
+    with _login_limiter_lock:
+        if _login_limiter is None:
+            _login_limiter = TokenBucketLimiter(LoginBucket.__table__, app.config['LOGIN_RATE_LIMIT_BURST'],
+                                                app.config['LOGIN_RATE_LIMIT_PER_MINUTE'] / 60.0)
+        return _login_limiter
 
 @app.route('/log', methods=['GET', 'POST'])
 def log():
@@ -452,22 +1510,36 @@ def log():
         password = request.form['password']
         rol = request.form['rol']
 
-        conn = sqlite3.connect('instance/database.db')
-        c = conn.cursor()
+        # Every attempt takes a token before any password hash is computed, and a
+        # successful one gives it back, so parallel guesses cannot outrun the limit
+        limiter = get_login_limiter()
+        limit_keys = (f'user:{nombre}', f'ip:{request.remote_addr}')
+        if not limiter.acquire(db.session, limit_keys):
+            flash("Demasiados intentos fallidos. Intente de nuevo más tarde.", "danger")
+            response = app.make_response((render_template('login.html'), 429))
+            response.headers['Retry-After'] = str(int(limiter.retry_after(db.session, limit_keys)) + 1)
+            return response
 
         if rol == 'medical':
-            c.execute('SELECT name, password, role FROM medical WHERE name = ?', (nombre,))
+            resultado = db.session.execute(
+                db.select(medical.id, medical.name, medical.password, medical.role).where(medical.name == nombre)
+            ).first()
         else:
+            limiter.refund(db.session, limit_keys)
             flash("Rol no válido", "danger")
-            conn.close()
             return redirect('/')
 
-        resultado = c.fetchone()
-        conn.close()
-
         if resultado:
-            db_name, password_hash, db_rol = resultado
+            user_id, db_name, password_hash, db_rol = resultado
             if check_password_hash(password_hash, password):
+                # Upgrade hashes made with older cost parameters while we have the password
+                method = app.config['PASSWORD_HASH_METHOD']
+                if needs_rehash(password_hash, method):
+                    db.session.execute(db.update(medical).where(medical.id == user_id)
+                                       .values(password=generate_password_hash(password, method=method)))
+                    db.session.commit()
+                limiter.refund(db.session, limit_keys)
+                session['user_id'] = user_id
                 session['role'] = db_rol
                 if db_rol == 'medical':
                     return render_template('Mirai.html')
@@ -487,33 +1559,118 @@ def reg():
         password = request.form['password']
         rol = request.form['rol']
 
-        hashed_password = generate_password_hash(password)
-        conn = sqlite3.connect('instance/database.db')
-        c = conn.cursor()
+        hashed_password = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
 
         try:
             if rol == 'patient':
-                c.execute('INSERT INTO patient (name, password, role) VALUES (?, ?, ?)',
-                          (nombre, hashed_password, rol))
+                db.session.add(patient(name=nombre, password=hashed_password, role=rol))
+                db.session.commit()
                 flash('Paciente registrado exitosamente', 'success')
-                conn.commit()
             elif rol == 'medical':
-                c.execute('INSERT INTO medical (name, password, role) VALUES (?, ?, ?)',
-                          (nombre, hashed_password, rol))
-                conn.commit()
+                db.session.add(medical(name=nombre, password=hashed_password, role=rol))
+                db.session.commit()
                 flash(f'Responsable registrado exitosamente.', 'info')
                 return redirect('/log')
             else:
                 flash('Rol no válido', 'danger')
                 return redirect('/reg')
-        except sqlite3.Error as e:
+        except SQLAlchemyError as e:
             flash(f"Error al registrar: {e}", "danger")
-            conn.rollback()
-        finally:
-            conn.close()
+            db.session.rollback()
 
     return render_template('reg.html')
 
 
+def store_batch_result(run_id, result):
+    entry = BatchResult.query.filter_by(run_id=run_id, study_uid=result['study_uid']).first()
+    if entry is None:
+        entry = BatchResult(run_id=run_id, study_uid=result['study_uid'])
+        db.session.add(entry)
+    entry.patient_id = result.get('patient_id')
+    entry.status = result['status']
+    entry.predictions = json.dumps(result['predictions']) if result.get('predictions') is not None else None
+    entry.error = result.get('error')
+    entry.latency = result.get('latency')
+    entry.file_paths = json.dumps(result.get('files') or [])
+    entry.created_at = datetime.now()
+    db.session.commit()
+
+@app.cli.command('mirai-batch')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--run-id', help='Name of the run; reuse it to resume. Defaults to a hash of SOURCE.')
+@click.option('--output', help='Results file, .csv or .parquet. Defaults to batch_<run id>.csv.')
+@click.option('--concurrency', type=int, help='Studies in flight at once. Defaults to INFERENCE_WORKERS.')
+@click.option('--allow-incomplete', is_flag=True, help='Also score studies that do not have all 4 views.')
+def mirai_batch(source, run_id, output, concurrency, allow_incomplete):
+    """Score every study in SOURCE (a folder of DICOMs or a manifest) with Mirai."""
+    init_storage()
+    run_id = run_id or hashlib.sha256(os.path.abspath(source).encode()).hexdigest()[:16]
+    output = output or f'batch_{run_id}.csv'
+    csv_path = output[:-len('.parquet')] + '.csv' if output.endswith('.parquet') else output
+
+    done = {uid for (uid,) in db.session.query(BatchResult.study_uid).filter_by(run_id=run_id, status='done')}
+    click.echo(f'Run {run_id}: writing results to {csv_path}')
+
+    # Own client with a connection per concurrent study, so keep-alive connections are reused
+    concurrency = concurrency or app.config['INFERENCE_WORKERS']
+    model_client = build_model_client(concurrency)
+
+    def infer(paths):
+        with app.app_context():
+            return run_inference(paths, model_client)
+
+    writer = CsvResultWriter(csv_path)
+    def on_result(result):
+        store_batch_result(run_id, result)
+        writer.write(result)
+
+    try:
+        summary = run_batch(source, infer, on_result, done=done,
+                            concurrency=concurrency,
+                            allow_incomplete=allow_incomplete, log=click.echo)
+    finally:
+        writer.close()
+        model_client.session.close()
+
+    if output.endswith('.parquet'):
+        try:
+            csv_to_parquet(csv_path, output)
+        except ImportError as e:
+            click.echo(f'Could not write {output} ({e}); results are in {csv_path}')
+
+    counts = summary['counts']
+    click.echo(f"Scored {counts['done']} studies ({counts['failed']} failed, {counts['incomplete']} incomplete, "
+               f"{summary['skipped_done']} already done) in {summary['elapsed']:.1f} s: "
+               f"{summary['studies_per_min']:.1f} studies/min")
+    for stage, stats in summary['stages'].items():
+        click.echo(f"  {stage:<10} n={stats['count']:<6} mean {stats['mean'] * 1000:8.1f} ms  "
+                   f"p50 {stats['p50'] * 1000:8.1f} ms  p95 {stats['p95'] * 1000:8.1f} ms")
+
+
+@app.cli.command('index-dicoms')
+@click.argument('folder', required=False, type=click.Path(exists=True, file_okay=False))
+def index_dicoms(folder):
+    """Back-fill the DICOM search index from FOLDER (default: UPLOAD_FOLDER), reading headers only."""
+    init_storage()
+    start = time.perf_counter()
+    count = backfill_dicom_index(folder or app.config['UPLOAD_FOLDER'], log=click.echo)
+    click.echo(f'Indexed {count} files in {time.perf_counter() - start:.1f} s')
+
+
+@app.cli.command('storage-gc')
+@click.option('--batch', type=int, help='Files to hash or compress in this pass. Defaults to all of them.')
+def storage_gc(batch):
+    """Run one storage GC pass now and print the storage report."""
+    init_storage()
+    app.config['STORAGE_GC_INTERVAL'] = 0 # no background thread for a one-off command
+    summary = get_storage_gc().run_pass(batch=batch if batch is not None else float('inf'))
+    if summary is None:
+        click.echo('Another process is running a storage GC pass; try again later.')
+        return
+    click.echo(json.dumps({'pass': summary, **get_storage_gc().stats()}, indent=2))
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Port 5000 is taken by the Mirai container (see MIRAI_ENDPOINTS)
+    # Development server only; production runs wsgi.py under gunicorn (see gunicorn.conf.py)
+    create_app().run(debug=True, port=int(os.environ.get('PORT', 8000)))
\ No newline at end of file
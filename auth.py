@@ -0,0 +1,88 @@
+"""Login helpers: password-hash cost and failed-login rate limiting.
+
+- Password hashes are werkzeug strings ("<method>$<salt>$<hash>"), so the
+  method prefix tells whether a stored hash was made with the configured
+  cost; needs_rehash() compares the two so /log can upgrade it in place.
+- TokenBucketLimiter takes a token from the user's and the client IP's
+  bucket before any hash is computed and gives it back when the login
+  succeeds, so only failed attempts use up the allowance. An empty bucket
+  rejects further attempts until it refills. The buckets live in a
+  database table, so every worker process shares them and concurrent
+  guesses cannot all pass a check made before the slow hash.
+"""
+import functools
+import time
+
+from sqlalchemy import delete, func, select, update
+from werkzeug.security import generate_password_hash
+
+
+@functools.lru_cache(maxsize=None)
+def normalize_hash_method(method):
+    """Full method string werkzeug writes for method, e.g. 'scrypt' -> 'scrypt:32768:8:1'"""
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash, method):
+    """Whether password_hash was made with other parameters than method"""
+    return password_hash.split('$', 1)[0] != normalize_hash_method(method)
+
+
+class TokenBucketLimiter:
+    """Token buckets of capacity tokens per key, refilled at rate tokens/second.
+
+    table needs the columns key (primary key), tokens and updated (Unix
+    time). A key without a row has a full bucket. Every method commits the
+    given SQLAlchemy session.
+    """
+
+    def __init__(self, table, capacity, rate):
+        self.table = table
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+
+    def _tokens(self, now):
+        """SQL expression for a bucket's tokens at time now"""
+        return func.min(self.capacity, self.table.c.tokens + (now - self.table.c.updated) * self.rate)
+
+    def acquire(self, session, keys):
+        """Take one token from every key's bucket; False (and nothing taken) if any bucket is empty"""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        t = self.table
+        try:
+            # Writing first takes SQLite's write lock, so the check and the take are one step for every process
+            taken = session.execute(
+                update(t).where(t.c.key.in_(keys), self._tokens(now) >= 1)
+                .values(tokens=self._tokens(now) - 1, updated=now)
+            ).rowcount
+            existing = set(session.scalars(select(t.c.key).where(t.c.key.in_(keys))))
+            if taken < len(existing):
+                session.rollback()
+                return False
+            missing = [key for key in keys if key not in existing]
+            if missing:
+                session.execute(t.insert(), [{'key': key, 'tokens': self.capacity - 1, 'updated': now}
+                                             for key in missing])
+            session.commit()
+            return True
+        except BaseException:
+            session.rollback()
+            raise
+
+    def refund(self, session, keys):
+        """Give back the tokens acquire() took, and forget buckets that are full again"""
+        now = time.time()
+        t = self.table
+        session.execute(update(t).where(t.c.key.in_(list(keys)))
+                        .values(tokens=func.min(self.capacity, self._tokens(now) + 1), updated=now))
+        session.execute(delete(t).where(self._tokens(now) >= self.capacity))
+        session.commit()
+
+    def retry_after(self, session, keys):
+        """Seconds until every key has a token again"""
+        now = time.time()
+        lowest = session.scalar(select(func.min(self._tokens(now))).where(self.table.c.key.in_(list(keys))))
+        session.commit()
+        missing = 1 - (self.capacity if lowest is None else lowest)
+        return max(0.0, missing / self.rate) if self.rate else float('inf')
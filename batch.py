@@ -0,0 +1,240 @@
+"""Batch scoring of archived mammography studies.
+
+Used by the `flask mirai-batch` command in app.py, but independent of the
+database: the caller passes the inference function, the set of studies a
+previous run already finished (to resume) and a callback that persists
+each result as it arrives.
+
+Pipeline:
+1. collect DICOM paths from a directory tree or a manifest file;
+2. read headers only (in parallel) and group files into studies by
+   StudyInstanceUID, ordering the views L-CC, L-MLO, R-CC, R-MLO;
+3. send complete studies to the model with a bounded number in flight.
+"""
+import csv
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ingest import read_header
+
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+VIEWS = [('L', 'CC'), ('L', 'MLO'), ('R', 'CC'), ('R', 'MLO')]
+CSV_FIELDS = ['study_uid', 'patient_id', 'status', 'predictions', 'error', 'latency', 'files']
+
+
+class BatchStudy:
+    def __init__(self, study_uid, patient_id=None):
+        self.study_uid = study_uid
+        self.patient_id = patient_id
+        self.views = {}  # (laterality, view) -> path
+        self.extra = []  # files whose view could not be identified
+
+    def add(self, path, laterality, view):
+        key = (laterality, view)
+        if key in VIEWS and key not in self.views:
+            self.views[key] = path
+        else:
+            self.extra.append(path)
+
+    @property
+    def complete(self):
+        return all(key in self.views for key in VIEWS)
+
+    @property
+    def paths(self):
+        return [self.views[key] for key in VIEWS if key in self.views] + self.extra
+
+
+class StageTimer:
+    """Collects per-stage latencies from several threads"""
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        result = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            result[stage] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': values[len(values) // 2],
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            }
+        return result
+
+
+def collect_paths(source):
+    """DICOM paths from a directory (recursive) or a manifest.
+
+    A manifest is either a CSV with a 'path' column or a plain text file with
+    one path per line; relative paths are resolved against its folder.
+    """
+    if os.path.isdir(source):
+        paths = []
+        for root, _, filenames in os.walk(source):
+            paths += [os.path.join(root, name) for name in filenames
+                      if name.lower().endswith(DICOM_EXTENSIONS)]
+        return sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        if source.lower().endswith('.csv'):
+            entries = [row['path'] for row in csv.DictReader(f) if row.get('path')]
+        else:
+            entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [entry if os.path.isabs(entry) else os.path.join(base, entry) for entry in entries]
+
+
+def read_view(path):
+    """(study uid, patient id, laterality, view) from the header only"""
+    ds = read_header(path)
+    study_uid = str(ds.get('StudyInstanceUID', '') or f'unknown:{path}')
+    laterality = str(ds.get('ImageLaterality', '') or ds.get('Laterality', '')).upper()
+    view = str(ds.get('ViewPosition', '')).upper()
+    return study_uid, str(ds.get('PatientID', '')), laterality, view
+
+
+def group_studies(paths, workers=8, timer=None):
+    """Group files into BatchStudy objects, reading headers in parallel"""
+    studies = {}
+    unreadable = []
+
+    def timed_read(path):
+        start = time.perf_counter()
+        try:
+            return path, read_view(path)
+        except Exception as e:
+            return path, e
+        finally:
+            if timer:
+                timer.add('header', time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, result in pool.map(timed_read, paths):
+            if isinstance(result, Exception):
+                unreadable.append((path, str(result)))
+                continue
+            study_uid, patient_id, laterality, view = result
+            study = studies.setdefault(study_uid, BatchStudy(study_uid, patient_id))
+            study.add(path, laterality, view)
+    return list(studies.values()), unreadable
+
+
+class CsvResultWriter:
+    """Appends one row per finished study and flushes it immediately"""
+
+    def __init__(self, path):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=CSV_FIELDS)
+        if new_file:
+            self._writer.writeheader()
+
+    def write(self, result):
+        self._writer.writerow({
+            'study_uid': result['study_uid'],
+            'patient_id': result.get('patient_id') or '',
+            'status': result['status'],
+            'predictions': ' '.join(str(p) for p in result.get('predictions') or []),
+            'error': result.get('error') or '',
+            'latency': f"{result.get('latency', 0):.3f}",
+            'files': ' '.join(result.get('files') or []),
+        })
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def csv_to_parquet(csv_path, parquet_path):
+    """Convert the CSV results to Parquet (needs pandas with pyarrow or fastparquet)"""
+    import pandas as pd
+    pd.read_csv(csv_path).drop_duplicates('study_uid', keep='last').to_parquet(parquet_path, index=False)
+
+
+def run_batch(source, infer, on_result, done=(), concurrency=4, header_workers=8,
+              allow_incomplete=False, log=print):
+    """Score every study under source that is not already in done.
+
+    infer(paths) must return the run_inference() payload; on_result(result)
+    is called from this thread for every finished study, in completion
+    order. Returns a summary with throughput and per-stage latency.
+    """
+    timer = StageTimer()
+    started = time.perf_counter()
+
+    paths = collect_paths(source)
+    studies, unreadable = group_studies(paths, header_workers, timer)
+    for path, error in unreadable:
+        log(f'Skipping unreadable file {path}: {error}')
+
+    done = set(done)
+    pending = [study for study in studies if study.study_uid not in done]
+    log(f'{len(paths)} files, {len(studies)} studies, {len(studies) - len(pending)} already done, '
+        f'{len(pending)} to score')
+
+    counts = {'done': 0, 'failed': 0, 'incomplete': 0}
+
+    def score(study):
+        start = time.perf_counter()
+        try:
+            payload = infer(study.paths)
+        except Exception as e:
+            payload = {'success': False, 'error': str(e)}
+        latency = time.perf_counter() - start
+        timer.add('inference', latency)
+        result = {'study_uid': study.study_uid, 'patient_id': study.patient_id,
+                  'files': study.paths, 'latency': latency}
+        if payload.get('success'):
+            data = (payload.get('target_response') or {}).get('data') or {}
+            result.update(status='done', predictions=data.get('predictions'), cache=payload.get('cache'))
+        else:
+            result.update(status='failed', error=payload.get('error'))
+        return result
+
+    def finish(result):
+        start = time.perf_counter()
+        on_result(result)
+        timer.add('write', time.perf_counter() - start)
+        counts[result['status']] += 1
+        finished = sum(counts.values())
+        if finished % 50 == 0 or finished == len(pending):
+            elapsed = time.perf_counter() - started
+            log(f'{finished}/{len(pending)} studies, {finished / elapsed * 60:.1f} studies/min')
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = set()
+        for study in pending:
+            if not study.complete and not allow_incomplete:
+                finish({'study_uid': study.study_uid, 'patient_id': study.patient_id, 'files': study.paths,
+                        'status': 'incomplete', 'latency': 0.0,
+                        'error': f'Expected 4 views, found {len(study.views)}'})
+                continue
+            # Bounded pipeline: never more than `concurrency` studies in flight
+            if len(in_flight) >= concurrency:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(future.result())
+            in_flight.add(pool.submit(score, study))
+        for future in wait(in_flight).done:
+            finish(future.result())
+
+    elapsed = time.perf_counter() - started
+    scored = counts['done'] + counts['failed']
+    return {
+        'files': len(paths),
+        'studies': len(studies),
+        'skipped_done': len(studies) - len(pending),
+        'counts': counts,
+        'elapsed': elapsed,
+        'studies_per_min': scored / elapsed * 60 if elapsed else 0.0,
+        'stages': timer.summary(),
+    }
@@ -0,0 +1,115 @@
+"""Login and study-listing latency with 50 concurrent users.
+
+Starts the app on a threaded local server from a scratch working directory,
+registers one medical account, seeds PDF studies, then runs --users client
+threads for --duration seconds. Each user alternates a POST /log with a
+GET /ver_estudios_pdf page, and the script reports p50/p95/p99 latency and
+throughput per endpoint.
+
+Usage: python benchmarks/bench_db.py [--users 50 --duration 20 --studies 5000 --hash-method scrypt:16384:8:1]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def user_loop(base_url, deadline, pages, samples, errors, lock):
+    session = requests.Session()
+    while time.perf_counter() < deadline:
+        for name, call in (
+            ('login', lambda: session.post(f'{base_url}/log', data={
+                'nombre': 'bench', 'password': 'bench-password', 'rol': 'medical'})),
+            ('listing', lambda: session.get(f'{base_url}/ver_estudios_pdf',
+                                            params={'page': random.randint(1, pages)})),
+        ):
+            start = time.perf_counter()
+            try:
+                response = call()
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    samples[name].append(elapsed)
+                else:
+                    errors[name] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--studies', type=int, default=5000)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--hash-method', help='PASSWORD_HASH_METHOD for the benchmark account')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'database.db')
+        import app as mirai_app
+        # Every user logs in to the same account from the same IP; a login in progress holds a token
+        mirai_app.create_app({'LOGIN_RATE_LIMIT_BURST': args.users + 5})
+        from werkzeug.serving import make_server
+        from werkzeug.security import generate_password_hash
+
+        if args.hash_method:
+            mirai_app.app.config['PASSWORD_HASH_METHOD'] = args.hash_method
+        method = mirai_app.app.config['PASSWORD_HASH_METHOD']
+
+        with mirai_app.app.app_context():
+            db = mirai_app.db
+            db.session.add(mirai_app.medical(name='bench', role='medical',
+                                             password=generate_password_hash('bench-password', method=method)))
+            db.session.execute(mirai_app.PDFStudy.__table__.insert(), [
+                {'study_name': f'Estudio {i}', 'filename_1': f'{i}_1.pdf', 'filename_2': f'{i}_2.pdf'}
+                for i in range(args.studies)])
+            db.session.commit()
+            journal = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', args.port, mirai_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{args.port}'
+        pages = max(1, -(-args.studies // mirai_app.app.config['LIST_PER_PAGE']))
+
+        samples = {'login': [], 'listing': []}
+        errors = {'login': 0, 'listing': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + args.duration
+        users = [threading.Thread(target=user_loop, args=(base_url, deadline, pages, samples, errors, lock))
+                 for _ in range(args.users)]
+        started = time.perf_counter()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+
+    print(f'{args.users} users, {elapsed:.1f} s, {args.studies} studies, journal_mode={journal}, {method}, '
+          f'{os.cpu_count()} CPUs')
+    for name, values in samples.items():
+        print(f'{name:<8} n={len(values):<6} errors={errors[name]:<4} {len(values) / elapsed:7.1f} req/s  '
+              f'p50 {percentile(values, 0.50) * 1000:7.1f} ms  p95 {percentile(values, 0.95) * 1000:7.1f} ms  '
+              f'p99 {percentile(values, 0.99) * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
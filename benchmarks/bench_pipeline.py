@@ -0,0 +1,461 @@
+"""Load test of the whole upload -> inference -> report pipeline.
+
+Starts the fake Mirai container (fake_mirai.py) and the app as separate
+processes in a scratch directory, then runs every concurrency level with
+that many virtual users. Each user takes --iterations patients through
+the clinic flow:
+
+    POST /upload (4 views) -> POST /upload_pdf -> POST /process_recent_dicoms
+    -> poll /jobs/<id> -> POST /generate_report_pdf -> poll /reports/jobs/<id>
+    -> GET /reports/<file>
+
+Every upload gets random bytes in the DICOM preamble, which readers ignore,
+so the content-addressed storage, the pixel cache and the inference cache
+all miss as they would for new patients. --repeat-files sends identical
+files every time to measure the cached paths instead.
+
+For each image profile (size x transfer syntax) and level it reports
+p50/p95/p99 latency and throughput per endpoint, the end-to-end job
+times, the peak RSS of the server (the app process plus its pools,
+summed, so shared pages count once per process) and the mean time of
+each pipeline stage taken from /metrics. --output saves the results as
+JSON; --compare checks them against an earlier file and exits with
+status 1 if a p95 got slower by more than --tolerance.
+
+Usage: python benchmarks/bench_pipeline.py [--concurrency 1 2 4 8 --iterations 2 --model-latency 0.5
+           --sizes 4096x3328 2048x1664 --syntaxes explicit rle --server werkzeug|gunicorn
+           --output results.json --compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import requests
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+
+ENDPOINTS = ['upload', 'upload_pdf', 'process_recent_dicoms', 'inference_job',
+             'generate_report_pdf', 'report_job', 'report_download', 'flow']
+POLL_INTERVAL = 0.1 # Seconds between job status checks (polls are not timed)
+JOB_TIMEOUT = 600
+STAGE_LINE = re.compile(r'^mirai_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+# Loaded by both server modes; histograms are flushed every second so /metrics is current after a level
+WSGI_MODULE = """import sys
+sys.path.insert(0, {repo!r})
+from app import create_app
+application = create_app({{'METRICS_FLUSH_INTERVAL': 1}})
+"""
+
+
+class FlowFailed(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} exited with status {process.returncode}')
+        try:
+            requests.get(url, timeout=5)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout} s')
+
+
+def tree_rss(pid):
+    """Summed resident memory of a process and its descendants, in bytes (None if unavailable)"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [root] + root.children(recursive=True))
+        except psutil.Error:
+            return None
+    if not os.path.isdir('/proc'):
+        return None
+
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children[ppid].append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+        stack.extend(children.get(current, ()))
+    return total
+
+
+class RssSampler:
+    """Peak of tree_rss(pid), sampled on a background thread"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+def stage_totals(base_url):
+    """{stage: (total seconds, count)} from the app's /metrics"""
+    totals = defaultdict(lambda: [0.0, 0])
+    for line in requests.get(f'{base_url}/metrics', timeout=30).text.splitlines():
+        match = STAGE_LINE.match(line)
+        if match:
+            totals[match.group(2)][0 if match.group(1) == 'sum' else 1] = float(match.group(3))
+    return totals
+
+
+def write_pdf(path, text):
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(path)
+    pdf.drawString(72, 720, text)
+    pdf.showPage()
+    pdf.save()
+    return path
+
+
+def upload_parts(paths, unique):
+    parts = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if unique:
+            data = os.urandom(16) + data[16:]  # inside the 128-byte preamble
+        parts.append(('file', (os.path.basename(path), data, 'application/dicom')))
+    return parts
+
+
+def run_flow(session, base_url, dicoms, pdfs, unique, record):
+    """One patient through the pipeline; record(name, seconds or None) gets every timed step"""
+
+    def timed(name, call, accept=lambda response: response.ok):
+        start = time.perf_counter()
+        try:
+            response = call()
+            ok = accept(response)
+        except (requests.RequestException, ValueError, KeyError):
+            ok = False
+        record(name, time.perf_counter() - start if ok else None)
+        if not ok:
+            raise FlowFailed(name)
+        return response
+
+    def wait_for(name, status_url):
+        start = time.perf_counter()
+        while time.perf_counter() - start < JOB_TIMEOUT:
+            body = session.get(base_url + status_url, timeout=30).json()
+            if body.get('status') in ('done', 'failed'):
+                ok = body['status'] == 'done'
+                record(name, time.perf_counter() - start if ok else None)
+                if not ok:
+                    raise FlowFailed(name)
+                return body['result']
+            time.sleep(POLL_INTERVAL)
+        record(name, None)
+        raise FlowFailed(name)
+
+    parts = upload_parts(dicoms, unique)
+    started = time.perf_counter()
+    body = timed('upload', lambda: session.post(f'{base_url}/upload', files=parts, timeout=600),
+                 lambda r: r.ok and r.json()['success'] and not r.json()['errors']).json()
+    study_session_id = body['study_session_id']
+
+    timed('upload_pdf', lambda: session.post(
+        f'{base_url}/upload_pdf', data={'study_session_id': study_session_id}, timeout=120,
+        files={'pdf1': ('a.pdf', pdfs[0], 'application/pdf'), 'pdf2': ('b.pdf', pdfs[1], 'application/pdf')}),
+          lambda r: r.ok and r.json()['success'])
+
+    body = timed('process_recent_dicoms', lambda: session.post(
+        f'{base_url}/process_recent_dicoms', json={'study_session_id': study_session_id}, timeout=120)).json()
+    result = wait_for('inference_job', body['status_url'])
+    predictions = result['target_response']['data']['predictions']
+    percentage = round(predictions[-1] * 100, 2)
+    risk_message = 'ALTO RIESGO' if percentage >= 2.9 else 'BAJO RIESGO'
+
+    response = timed('generate_report_pdf', lambda: session.post(
+        f'{base_url}/generate_report_pdf', timeout=120,
+        json={'study_session_id': study_session_id, 'percentage': percentage, 'riskMessage': risk_message}))
+    body = response.json()
+    if response.status_code == 202:
+        body = wait_for('report_job', body['status_url'])
+    timed('report_download', lambda: session.get(base_url + body['report_url'], timeout=120),
+          lambda r: r.ok and r.content.startswith(b'%PDF'))
+    record('flow', time.perf_counter() - started)
+
+
+def run_level(base_url, server_pid, concurrency, iterations, dicoms, pdfs, unique):
+    samples = defaultdict(list)
+    errors = Counter()
+    failed_flows = []
+    lock = threading.Lock()
+
+    def record(name, seconds):
+        with lock:
+            if seconds is None:
+                errors[name] += 1
+            else:
+                samples[name].append(seconds)
+
+    def user():
+        session = requests.Session()
+        for _ in range(iterations):
+            try:
+                run_flow(session, base_url, dicoms, pdfs, unique, record)
+            except FlowFailed as e:
+                with lock:
+                    failed_flows.append(str(e))
+
+    before = stage_totals(base_url)
+    sampler = RssSampler(server_pid).start()
+    users = [threading.Thread(target=user) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak_rss = sampler.stop()
+    time.sleep(2)  # worker processes flush their histograms every second
+    after = stage_totals(base_url)
+
+    endpoints = {}
+    for name in ENDPOINTS:
+        values = samples.get(name, [])
+        if not values and not errors[name]:
+            continue
+        endpoints[name] = {
+            'n': len(values),
+            'errors': errors[name],
+            'per_s': len(values) / elapsed,
+            'mean_ms': sum(values) / len(values) * 1000 if values else None,
+            'p50_ms': percentile(values, 0.50) * 1000 if values else None,
+            'p95_ms': percentile(values, 0.95) * 1000 if values else None,
+            'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+        }
+    stages = {}
+    for stage, (total, count) in sorted(after.items()):
+        count -= before[stage][1] if stage in before else 0
+        total -= before[stage][0] if stage in before else 0
+        if count:
+            stages[stage] = {'n': int(count), 'mean_ms': total / count * 1000}
+    return {
+        'concurrency': concurrency,
+        'duration_s': elapsed,
+        'flows': len(samples.get('flow', [])),
+        'failed_flows': len(failed_flows),
+        'flows_per_s': len(samples.get('flow', [])) / elapsed,
+        'peak_rss_mb': peak_rss / 1e6 if peak_rss else None,
+        'endpoints': endpoints,
+        'stages': stages,
+    }
+
+
+def fmt(value, spec='8.1f'):
+    return format(value, spec) if value is not None else format('-', spec[:-2].split('.')[0])
+
+
+def print_run(run):
+    print(f"\n{run['profile']} ({run['file_mb']:.1f} MB/file), {run['concurrency']} users: "
+          f"{run['flows']} flows in {run['duration_s']:.1f} s ({run['flows_per_s']:.2f}/s), "
+          f"{run['failed_flows']} failed, peak RSS {fmt(run['peak_rss_mb'], '.0f')} MB")
+    print(f"  {'endpoint':<22} {'n':>5} {'err':>4} {'req/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in run['endpoints'].items():
+        print(f"  {name:<22} {stats['n']:>5} {stats['errors']:>4} {stats['per_s']:>7.2f} "
+              f"{fmt(stats['p50_ms'], '9.1f')} {fmt(stats['p95_ms'], '9.1f')} {fmt(stats['p99_ms'], '9.1f')}")
+    if run['stages']:
+        print('  stages: ' + ', '.join(f"{stage} {stats['n']} x {stats['mean_ms']:.1f} ms"
+                                       for stage, stats in run['stages'].items()))
+
+
+def compare(runs, baseline, tolerance):
+    """Print p95 changes against a baseline results file; returns the number of regressions"""
+    previous = {(run['profile'], run['concurrency']): run for run in baseline['runs']}
+    regressions = 0
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'} "
+          f"({baseline['meta'].get('timestamp', '?')}), p95, tolerance {tolerance:.0%}:")
+    for run in runs:
+        old_run = previous.get((run['profile'], run['concurrency']))
+        if old_run is None:
+            continue
+        for name, stats in run['endpoints'].items():
+            old = old_run['endpoints'].get(name, {}).get('p95_ms')
+            new = stats['p95_ms']
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            flag = 'REGRESSION' if change > tolerance else ''
+            regressions += bool(flag)
+            print(f"  {run['profile']:<22} {run['concurrency']:>3} users  {name:<22} "
+                  f"{old:9.1f} -> {new:9.1f} ms  {change:+7.1%}  {flag}")
+    return regressions
+
+
+def start_server(args, tmp, port, mirai_url):
+    with open(os.path.join(tmp, 'bench_wsgi.py'), 'w') as f:
+        f.write(WSGI_MODULE.format(repo=REPO))
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tmp, 'database.db'),
+               MIRAI_ENDPOINTS=mirai_url, SECRET_KEY='bench', PYTHONPATH=tmp + os.pathsep + REPO,
+               BIND=f'127.0.0.1:{port}')
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO, 'gunicorn.conf.py'),
+                   'bench_wsgi:application']
+    else:
+        command = [sys.executable, '-c', 'from bench_wsgi import application\n'
+                   'from werkzeug.serving import run_simple\n'
+                   f'run_simple("127.0.0.1", {port}, application, threaded=True)']
+    log = open(os.path.join(tmp, 'server.log'), 'w')
+    # Own process group, so stop_server() also reaches the app's pool processes
+    return subprocess.Popen(command, cwd=tmp, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=os.name == 'posix'), log
+
+
+def stop_server(server):
+    if os.name == 'posix':
+        import signal
+        try:
+            os.killpg(server.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    else:
+        server.terminate()
+    server.wait(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--iterations', type=int, default=2, help='patients per user and level')
+    parser.add_argument('--sizes', nargs='+', default=['4096x3328'], help='ROWSxCOLS of the synthetic views')
+    parser.add_argument('--syntaxes', nargs='+', default=['explicit', 'rle'],
+                        choices=sorted(synthetic.TRANSFER_SYNTAXES))
+    parser.add_argument('--model-latency', type=float, default=0.5, help='seconds per fake inference')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--repeat-files', action='store_true', help='upload identical files (cache hits)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='earlier JSON results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed p95 slowdown (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    meta = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'args': vars(args)}
+    runs = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdfs = []
+        for name in ('a', 'b'):
+            with open(write_pdf(os.path.join(tmp, f'{name}.pdf'), f'Estudio de prueba {name}'), 'rb') as f:
+                pdfs.append(f.read())
+
+        mirai_port, app_port = free_port(), free_port()
+        fake = subprocess.Popen([sys.executable, os.path.join(REPO, 'benchmarks', 'fake_mirai.py'),
+                                 '--port', str(mirai_port), '--latency', str(args.model_latency)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server, server_log = start_server(args, tmp, app_port, f'http://127.0.0.1:{mirai_port}/dicom/files')
+        base_url = f'http://127.0.0.1:{app_port}'
+        try:
+            wait_until_up(f'http://127.0.0.1:{mirai_port}/', fake)
+            wait_until_up(base_url + '/', server)
+            print(f'{args.server} server, fake model latency {args.model_latency} s, {os.cpu_count()} CPUs')
+
+            for size in args.sizes:
+                rows, cols = (int(n) for n in size.lower().split('x'))
+                for syntax in args.syntaxes:
+                    profile = f'{rows}x{cols} {syntax}'
+                    print(f'\nGenerating a 4-view {profile} study...')
+                    dicoms = synthetic.write_study(os.path.join(tmp, 'source', profile.replace(' ', '_')),
+                                                   rows=rows, cols=cols, transfer_syntax=syntax)
+                    file_mb = sum(os.path.getsize(path) for path in dicoms) / len(dicoms) / 1e6
+                    for concurrency in args.concurrency:
+                        run = run_level(base_url, server.pid, concurrency, args.iterations, dicoms, pdfs,
+                                        not args.repeat_files)
+                        run.update(profile=profile, rows=rows, cols=cols, syntax=syntax, file_mb=file_mb)
+                        runs.append(run)
+                        print_run(run)
+        except Exception:
+            server_log.flush()
+            with open(os.path.join(tmp, 'server.log')) as f:
+                print('--- server log (tail) ---\n' + ''.join(f.readlines()[-30:]), file=sys.stderr)
+            raise
+        finally:
+            stop_server(server)
+            fake.terminate()
+            fake.wait(timeout=60)
+            server_log.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'runs': runs}, f, indent=2)
+        print(f'\nResults written to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(runs, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{regressions} regression(s)')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
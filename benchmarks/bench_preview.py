@@ -0,0 +1,95 @@
+"""Compare the old matplotlib preview path with preview.py.
+
+Usage: python benchmarks/bench_preview.py [--rows 4096 --cols 3328 --repeat 5 --threads 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pydicom
+from pydicom.pixel_data_handlers import apply_voi_lut
+
+import preview
+import synthetic
+
+
+def matplotlib_preview(dcm_path, preview_path):
+    """The generate_preview implementation this benchmark replaces"""
+    ds = pydicom.dcmread(dcm_path)
+    data = apply_voi_lut(ds.pixel_array, ds)
+    data = (data - data.min()) / (data.max() - data.min()) * 255.0
+    data = data.astype('uint8')
+
+    plt.figure(figsize=(4, 4), dpi=100)
+    plt.imshow(data, cmap=plt.cm.gray)
+    plt.axis('off')
+    plt.savefig(preview_path, bbox_inches='tight', pad_inches=0)
+    plt.close()
+
+
+def fast_preview(dcm_path, preview_path):
+    preview.write_previews(dcm_path, preview_path)
+
+
+def measure(func, dcm_path, out_dir, repeat):
+    timings = []
+    peak = 0
+    for i in range(repeat):
+        out = os.path.join(out_dir, f'{func.__name__}_{i}.png')
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(dcm_path, out)
+        timings.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    timings.sort()
+    return timings[len(timings) // 2], peak
+
+
+def measure_threaded(func, paths, out_dir, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda item: func(item[1], os.path.join(out_dir, f't{item[0]}.png')),
+                      enumerate(paths)))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=4096)
+    parser.add_argument('--cols', type=int, default=3328)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dcm_path = synthetic.write_dicom(os.path.join(tmp, 'bench.dcm'), rows=args.rows, cols=args.cols)
+        print(f'Synthetic image: {args.rows}x{args.cols}, {os.path.getsize(dcm_path) / 1e6:.1f} MB')
+
+        results = {}
+        for func in (matplotlib_preview, fast_preview):
+            median, peak = measure(func, dcm_path, tmp, args.repeat)
+            results[func.__name__] = median
+            print(f'{func.__name__:<20} median {median * 1000:8.1f} ms   peak {peak / 1e6:7.1f} MB')
+        print(f'speedup: {results["matplotlib_preview"] / results["fast_preview"]:.1f}x')
+
+        # matplotlib's pyplot state machine is not thread-safe, so only the
+        # new path is measured with concurrent workers.
+        paths = [dcm_path] * args.threads
+        serial = sum(measure(fast_preview, dcm_path, tmp, 1)[0] for _ in paths)
+        threaded = measure_threaded(fast_preview, paths, tmp, args.threads)
+        print(f'fast_preview x{args.threads}: serial {serial:.2f} s, '
+              f'{args.threads} threads {threaded:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
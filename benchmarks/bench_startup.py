@@ -0,0 +1,65 @@
+"""Cold-start cost of the app: import time, create_app() and first requests.
+
+Each run starts a fresh Python process in a scratch working directory (so
+the database and folders are created from nothing) and reports the median
+over --runs. It also lists which heavy libraries were imported by
+`import app` alone.
+
+Usage: python benchmarks/bench_startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['pypdf', 'reportlab', 'matplotlib', 'pydicom', 'numpy', 'PIL']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app as mirai_app
+imported = time.perf_counter()
+mirai_app.create_app()
+created = time.perf_counter()
+client = mirai_app.app.test_client()
+timings = {'import': imported - start, 'create_app': created - imported}
+for name, path in (('first GET /', '/'), ('first GET /ver_estudios_pdf', '/ver_estudios_pdf'),
+                   ('second GET /', '/')):
+    t = time.perf_counter()
+    assert client.get(path).status_code == 200
+    timings[name] = time.perf_counter() - t
+print(json.dumps({'timings': timings,
+                  'loaded': [m for m in %(heavy)r if m in sys.modules]}))
+"""
+
+
+def run_once():
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=REPO + os.pathsep + os.environ.get('PYTHONPATH', ''),
+                   DATABASE_URL='sqlite:///' + os.path.join(tmp, 'database.db'))
+        output = subprocess.run([sys.executable, '-c', PROBE % {'heavy': HEAVY_MODULES}], cwd=tmp, env=env,
+                                check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    print(f'{args.runs} cold starts, {os.cpu_count()} CPUs')
+    for name in results[0]['timings']:
+        values = [result['timings'][name] for result in results]
+        print(f'{name:<28} median {statistics.median(values) * 1000:8.1f} ms   '
+              f'min {min(values) * 1000:8.1f} ms')
+    print('heavy modules loaded by import:', ', '.join(results[0]['loaded']) or 'none')
+
+
+if __name__ == '__main__':
+    main()
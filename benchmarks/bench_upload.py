@@ -0,0 +1,84 @@
+"""Time /upload for 4- and 16-file batches with different UPLOAD_WORKERS settings.
+
+Runs the Flask app in-process with its test client from a scratch working
+directory, so uploads and previews don't end up in the repository. Every
+upload gets random bytes in the DICOM preamble, which readers ignore, so
+each one is new content: otherwise repeats would only measure the preview
+and pixel caches instead of the worker pool.
+
+Usage: python benchmarks/bench_upload.py [--rows 2048 --cols 1664 --workers 1 2 4 --pool thread]
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+
+
+def fresh_copy(content):
+    """The same DICOM with a new content hash"""
+    return io.BytesIO(os.urandom(16) + content[16:])  # inside the 128-byte preamble
+
+
+def upload_batch(client, files):
+    data = {'file': [(fresh_copy(content), name) for name, content in files]}
+    start = time.perf_counter()
+    response = client.post('/upload', data=data, content_type='multipart/form-data')
+    elapsed = time.perf_counter() - start
+    body = response.get_json()
+    if not body['success'] or body['errors']:
+        raise RuntimeError(f'Upload failed: {body}')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2048)
+    parser.add_argument('--cols', type=int, default=1664)
+    parser.add_argument('--batches', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--pool', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'database.db')
+        import app as mirai_app
+        mirai_app.create_app()
+
+        source = os.path.join(tmp, 'source')
+        paths = []
+        for study in range(-(-max(args.batches) // 4)):
+            paths += synthetic.write_study(source, rows=args.rows, cols=args.cols, seed=study)
+        print(f'{len(paths)} synthetic images, {args.rows}x{args.cols}, '
+              f'{os.path.getsize(paths[0]) / 1e6:.1f} MB each, {os.cpu_count()} CPUs')
+
+        files = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                files.append((os.path.basename(path), f.read()))
+
+        client = mirai_app.app.test_client()
+        for batch in args.batches:
+            baseline = None
+            for workers in args.workers:
+                mirai_app.app.config.update(UPLOAD_WORKERS=workers, UPLOAD_POOL=args.pool)
+                if mirai_app._upload_pool is not None:
+                    mirai_app._upload_pool.shutdown()
+                mirai_app._upload_pool = None
+                upload_batch(client, files[:1])  # warm up the pool
+                best = min(upload_batch(client, files[:batch]) for _ in range(args.repeat))
+                baseline = baseline or best
+                print(f'{batch:3d} files  {workers} {args.pool} worker(s)  {best:6.2f} s  '
+                      f'speedup {baseline / best:4.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Stand-in for the Ark:Mirai container's /dicom/files endpoint.
+
+Accepts the same multipart request the app sends (one or more 'dicom'
+parts plus a 'data' JSON field) and answers with five yearly risk
+predictions, after an optional delay. It can also fail a fraction of
+requests with a 500 to exercise retries and the circuit breaker.
+
+Usage: python benchmarks/fake_mirai.py [--port 5000 --latency 2.0 --fail-rate 0.1]
+"""
+import argparse
+import hashlib
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+
+def create_fake_mirai(latency=0.0, fail_rate=0.0):
+    fake = Flask('fake_mirai')
+    fake.config['LATENCY'] = latency
+    fake.config['FAIL_RATE'] = fail_rate
+    stats = fake.config['STATS'] = {'requests': 0, 'failures': 0}
+    lock = threading.Lock()
+
+    @fake.route('/dicom/files', methods=['POST'])
+    def dicom_files():
+        files = request.files.getlist('dicom')
+        with lock:
+            stats['requests'] += 1
+        if not files:
+            return jsonify({'success': False, 'error': 'No dicom file part received.'}), 400
+
+        time.sleep(fake.config['LATENCY'])
+        if random.random() < fake.config['FAIL_RATE']:
+            with lock:
+                stats['failures'] += 1
+            return jsonify({'success': False, 'error': 'Simulated model failure'}), 500
+
+        # Deterministic per set of files, like the real model
+        digest = hashlib.sha256()
+        for file in sorted(files, key=lambda f: f.filename):
+            digest.update(file.read())
+        base = int(digest.hexdigest()[:8], 16) / 0xffffffff * 0.02
+        predictions = [round(base * (year + 1), 6) for year in range(5)]
+        return jsonify({'data': {'predictions': predictions}})
+
+    return fake
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per inference')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    args = parser.parse_args()
+    create_fake_mirai(args.latency, args.fail_rate).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
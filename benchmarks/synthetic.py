@@ -0,0 +1,102 @@
+"""Synthetic mammography DICOMs for the benchmark scripts.
+
+The images are smooth gradients with some noise and a bright "breast"
+region so that windowing and PNG compression behave roughly like real
+full-field mammograms. They can be written in several transfer syntaxes;
+the JPEG ones need an encoder plugin (pylibjpeg-openjpeg, pyjpegls).
+"""
+import os
+import uuid
+
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import (DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                         JPEG2000Lossless, JPEGLSLossless, RLELossless, generate_uid)
+
+# Digital Mammography X-Ray Image Storage - For Presentation
+MAMMO_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.1.2'
+
+VIEWS = [('L', 'CC'), ('L', 'MLO'), ('R', 'CC'), ('R', 'MLO')]
+
+TRANSFER_SYNTAXES = {
+    'explicit': ExplicitVRLittleEndian,
+    'implicit': ImplicitVRLittleEndian,
+    'deflated': DeflatedExplicitVRLittleEndian,
+    'rle': RLELossless,
+    'jpeg2000': JPEG2000Lossless,
+    'jpegls': JPEGLSLossless,
+}
+
+
+def make_pixels(rows=4096, cols=3328, bits=12, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    cy, cx = rows / 2, cols * 0.2
+    tissue = np.clip(1.0 - ((y - cy) / (rows * 0.55)) ** 2 - ((x - cx) / (cols * 0.9)) ** 2, 0, 1)
+    noise = rng.normal(0, 0.02, size=(rows, cols)).astype(np.float32)
+    top = (1 << bits) - 1
+    return np.clip((tissue + noise) * top, 0, top).astype(np.uint16)
+
+
+def make_dataset(rows=4096, cols=3328, bits=12, laterality='L', view='CC',
+                 study_uid=None, patient_id='BENCH0001', seed=0, transfer_syntax='explicit'):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MAMMO_SOP_CLASS
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = MAMMO_SOP_CLASS
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid or generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.PatientName = 'Bench^Patient'
+    ds.PatientID = patient_id
+    ds.PatientAge = '052Y'
+    ds.PatientSex = 'F'
+    ds.StudyDate = '20240101'
+    ds.Modality = 'MG'
+    ds.BodyPartExamined = 'BREAST'
+    ds.ImageLaterality = laterality
+    ds.ViewPosition = view
+
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    ds.WindowCenter = (1 << bits) // 2
+    ds.WindowWidth = 1 << bits
+    ds.PixelData = make_pixels(rows, cols, bits, seed).tobytes()
+
+    uid = TRANSFER_SYNTAXES[transfer_syntax]
+    if uid.is_compressed:
+        ds.compress(uid)
+    else:
+        meta.TransferSyntaxUID = uid
+    return ds
+
+
+def write_dicom(path, **kwargs):
+    ds = make_dataset(**kwargs)
+    pydicom.dcmwrite(path, ds, write_like_original=False)
+    return path
+
+
+def write_study(folder, rows=4096, cols=3328, seed=0, transfer_syntax='explicit'):
+    """Write a synthetic 4-view study and return the file paths"""
+    os.makedirs(folder, exist_ok=True)
+    study_uid = generate_uid()
+    patient_id = f'BENCH{seed:04d}'
+    paths = []
+    for i, (laterality, view) in enumerate(VIEWS):
+        path = os.path.join(folder, f'{laterality}_{view}_{uuid.uuid4().hex[:8]}.dcm')
+        write_dicom(path, rows=rows, cols=cols, laterality=laterality, view=view,
+                    study_uid=study_uid, patient_id=patient_id, seed=seed * 4 + i,
+                    transfer_syntax=transfer_syntax)
+        paths.append(path)
+    return paths
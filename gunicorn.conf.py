@@ -0,0 +1,50 @@
+"""gunicorn settings for the Mirai app: gunicorn -c gunicorn.conf.py wsgi:application
+
+Every value can be overridden from the environment (or the command line).
+The app is loaded once in the master (preload_app), so folders, tables and
+job recovery are handled there, and workers are forked with the heavy
+imports already in memory.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# Threaded workers: uploads, SSE job streams and report downloads spend most
+# of their time waiting on I/O, while CPU-heavy work (previews, reports) runs
+# in the app's own pools
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 180)) # Large uploads on a slow LAN
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so fragmented native memory (pydicom, NumPy) is returned.
+# An exiting worker hands its unfinished inference jobs back to the queue (see worker_exit)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = 200
+
+# The app already logs one JSON line per request (with its trace id); set this for gunicorn's own log too
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+
+def post_fork(server, worker):
+    # SQLite connections opened in the master must not be shared with the workers
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # Runs in the exiting worker: let its inference jobs finish briefly, queue the rest for the others
+    from app import drain_jobs
+    drain_jobs(timeout=server.cfg.graceful_timeout / 2)
+
+
+def child_exit(server, worker):
+    # Fold the exited worker's latency histograms into metrics/dead.json
+    import telemetry
+    telemetry.compact()
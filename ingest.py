@@ -0,0 +1,156 @@
+"""Single-decode ingest of uploaded DICOM files.
+
+A ParsedDicom wraps one file on disk and is handed to every stage that
+needs it (metadata, preview, inference) so the file is only parsed once:
+
+* the dataset is read with a deferred PixelData element, so header-only
+  work never touches the pixel bytes;
+* the pixel array is decoded on first use and can be released afterwards;
+* the SHA-256 content hash is taken while the upload is streamed to disk,
+  or computed from disk on first use.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import pydicom
+
+from telemetry import span
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# Elements larger than this (in practice only PixelData) are read from disk
+# when they are first accessed instead of when the header is parsed.
+DEFER_SIZE = '256 KB'
+# How many parsed files to remember for later stages (pixels are released)
+REGISTRY_SIZE = 256
+# Stored uploads are named <sha256 of the uploaded bytes>.<ext>
+CONTENT_ADDRESSED = re.compile(r'([0-9a-f]{64})\.\w+')
+
+
+def read_header(path):
+    """Read only the DICOM header, stopping before the pixel data"""
+    with span('header_parse'):
+        return pydicom.dcmread(path, stop_before_pixels=True)
+
+
+def _header_value(ds, *keywords):
+    for keyword in keywords:
+        value = ds.get(keyword)
+        if value is not None and str(value).strip():
+            return str(value).strip()
+    return None
+
+
+def index_fields(ds):
+    """Searchable header fields of a dataset, keyed like the dicom_index columns"""
+    return {
+        'study_instance_uid': _header_value(ds, 'StudyInstanceUID'),
+        'patient_id': _header_value(ds, 'PatientID'),
+        'patient_name': _header_value(ds, 'PatientName'),
+        'study_date': _header_value(ds, 'StudyDate'),
+        'patient_age': _header_value(ds, 'PatientAge'),
+        'patient_sex': _header_value(ds, 'PatientSex'),
+        'modality': _header_value(ds, 'Modality'),
+        'body_part': _header_value(ds, 'BodyPartExamined'),
+        'laterality': _header_value(ds, 'ImageLaterality', 'Laterality'),
+        'view_position': _header_value(ds, 'ViewPosition'),
+    }
+
+
+def stored_hash(path):
+    """Content hash from a content-addressed file name, or None for other names"""
+    match = CONTENT_ADDRESSED.fullmatch(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ParsedDicom:
+    """A DICOM file parsed once and shared between ingest stages"""
+
+    def __init__(self, path, content_hash=None, pixel_cache=None):
+        self.path = path
+        self._content_hash = content_hash
+        self.pixel_cache = pixel_cache
+        self._dataset = None
+        self._pixels = None
+        self._lock = threading.Lock()
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            # The name is the hash of the uploaded bytes, which also holds for a file the
+            # storage GC has since recompressed
+            self._content_hash = stored_hash(self.path) or hash_file(self.path)
+        return self._content_hash
+
+    @property
+    def dataset(self):
+        """Parsed header; PixelData stays on disk until pixels is accessed"""
+        with self._lock:
+            if self._dataset is None:
+                with span('header_parse'):
+                    self._dataset = pydicom.dcmread(self.path, defer_size=DEFER_SIZE)
+            return self._dataset
+
+    @property
+    def pixels(self):
+        ds = self.dataset
+
+        def decode():
+            with span('pixel_decode'):
+                return ds.pixel_array
+
+        with self._lock:
+            if self._pixels is None:
+                if self.pixel_cache is not None:
+                    # Memory-mapped from the shared cache; decoded only on a miss
+                    self._pixels = self.pixel_cache.get(self.content_hash, decode)
+                else:
+                    self._pixels = decode()
+            return self._pixels
+
+    def release(self):
+        """Drop the dataset and decoded pixels, keeping path and hash"""
+        with self._lock:
+            self._dataset = None
+            self._pixels = None
+
+    def open(self):
+        return open(self.path, 'rb')
+
+
+_registry = OrderedDict()
+_registry_lock = threading.Lock()
+
+
+def remember(parsed):
+    """Keep a parsed file around so later stages can reuse its hash"""
+    with _registry_lock:
+        _registry[parsed.path] = parsed
+        _registry.move_to_end(parsed.path)
+        while len(_registry) > REGISTRY_SIZE:
+            _registry.popitem(last=False)
+    return parsed
+
+
+def get_parsed(path):
+    """Return the ParsedDicom registered for path, or a fresh one"""
+    with _registry_lock:
+        parsed = _registry.get(path)
+        if parsed is not None:
+            _registry.move_to_end(path)
+            return parsed
+    return ParsedDicom(path)
@@ -0,0 +1,88 @@
+"""In-process job queue with a fixed number of worker threads.
+
+Jobs themselves are rows in the database (see InferenceJob in app.py); the
+queue only carries their ids. The handler is called with the job id inside
+an application context, so it can load and update the row with the normal
+Flask-SQLAlchemy session. Queued or interrupted jobs are re-submitted from
+the database when the server starts again, and drain() lets a process that
+is shutting down finish (or hand back) the jobs it holds.
+"""
+import queue
+import threading
+import time
+
+from telemetry import log
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+
+
+class JobQueue:
+    def __init__(self, app, handler, workers=2, name='jobs'):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._held = set()  # ids queued here or running
+        self._running = set()
+        self._draining = False
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, job_id):
+        """Queue a job id unless this queue already holds it; returns whether it was added"""
+        with self._lock:
+            if job_id in self._held or self._draining:
+                return False
+            self._held.add(job_id)
+        self._queue.put(job_id)
+        return True
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def drain(self, timeout):
+        """Stop starting jobs and wait up to timeout seconds for the running ones.
+
+        Returns the ids of jobs that are still running.
+        """
+        with self._lock:
+            self._draining = True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._running:
+                    return set()
+            time.sleep(0.1)
+        with self._lock:
+            return set(self._running)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                skip = self._draining
+                if not skip:
+                    self._running.add(job_id)
+            try:
+                if not skip:
+                    with self.app.app_context():
+                        self.handler(job_id)
+            except Exception:
+                log.exception(f'Job {job_id} crashed')
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
+                    self._held.discard(job_id)
+                self._queue.task_done()
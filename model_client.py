@@ -0,0 +1,136 @@
+"""HTTP client for the Mirai model container(s).
+
+One ModelClient is shared by all inference workers. It keeps a pooled
+keep-alive requests.Session, applies connect/read timeouts, retries
+connection errors and 5xx answers with exponential backoff, and spreads
+requests round-robin over every configured endpoint. Each endpoint has a
+circuit breaker: after a run of failures it is skipped until a cool-down
+has passed, and when every endpoint is open requests fail immediately
+instead of waiting for timeouts.
+"""
+import itertools
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from telemetry import span
+
+
+class ModelUnavailable(requests.exceptions.ConnectionError):
+    """Every model endpoint is currently failing (all circuits open)"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent; lets a single trial through after the cool-down"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # A half-open trial that never reported back (e.g. the caller hit a
+            # local error) is replaced by a new one after another cool-down
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class ModelClient:
+    def __init__(self, endpoints, connect_timeout=3.05, read_timeout=300, retries=2, backoff=0.5,
+                 failure_threshold=5, reset_timeout=30.0, pool_size=10):
+        if not endpoints:
+            raise ValueError('At least one model endpoint is required')
+        self.endpoints = list(endpoints)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breakers = {url: CircuitBreaker(failure_threshold, reset_timeout) for url in self.endpoints}
+        self._turn = itertools.count()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _next_endpoint(self):
+        start = next(self._turn)
+        for i in range(len(self.endpoints)):
+            url = self.endpoints[(start + i) % len(self.endpoints)]
+            if self.breakers[url].allow():
+                return url
+        return None
+
+    def _post_once(self, url, paths, data):
+        files = []
+        try:
+            for path in paths:
+                files.append(('dicom', (os.path.basename(path), open(path, 'rb'), 'application/dicom')))
+            return self.session.post(url, files=files, data=data, timeout=self.timeout)
+        finally:
+            for _, (_, file_obj, _) in files:
+                file_obj.close()
+
+    def post_files(self, paths, data=None):
+        """POST the DICOM files at paths as 'dicom' parts and return the response.
+
+        Connection errors, timeouts and 5xx answers are retried on the next
+        available endpoint; 4xx answers are returned to the caller as-is.
+        """
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+
+            url = self._next_endpoint()
+            if url is None:
+                raise ModelUnavailable('All model endpoints are unavailable (circuit open)')
+            breaker = self.breakers[url]
+
+            try:
+                with span('model_roundtrip'):
+                    response = self._post_once(url, paths, data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                breaker.record_failure()
+                last_error = e
+                continue
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+                last_error = requests.exceptions.HTTPError(
+                    f'{response.status_code} Server Error from {url}', response=response)
+                continue
+
+            breaker.record_success()
+            return response
+
+        raise last_error
+
+    def status(self):
+        return {url: breaker.state for url, breaker in self.breakers.items()}
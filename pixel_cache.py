@@ -0,0 +1,137 @@
+"""Decoded DICOM pixel arrays cached on disk as memory-mapped .npy files.
+
+Decompressing a JPEG 2000 / JPEG-LS mammogram costs far more than reading
+its raw pixels back, so the first decode of a file is saved as
+<folder>/<content hash>.npy and every later reader gets
+np.load(mmap_mode='r'). Threads and worker processes that map the same
+file share its pages through the OS page cache instead of each holding a
+private copy.
+
+Recency lives in the files themselves (a hit touches the mtime), so all
+processes using the folder see one LRU order. After each miss the folder
+is trimmed, oldest first, to max_bytes. On POSIX a file that is evicted
+while mapped stays readable until the last map is closed.
+"""
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+SUFFIX = '.npy'
+
+
+class PixelCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._decoding = {}  # content hash -> lock, so a file is decoded once per process
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, content_hash):
+        return os.path.join(self.folder, content_hash + SUFFIX)
+
+    def _load(self, content_hash):
+        path = self.path(content_hash)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def get(self, content_hash, decode):
+        """Read-only pixel array for content_hash; decode() supplies it on a miss"""
+        array = self._load(content_hash)
+        if array is not None:
+            with self._lock:
+                self.hits += 1
+            return array
+
+        with self._lock:
+            decoding = self._decoding.setdefault(content_hash, threading.Lock())
+        with decoding:
+            # Another thread may have written it while we waited
+            array = self._load(content_hash)
+            if array is not None:
+                with self._lock:
+                    self.hits += 1
+                return array
+
+            with self._lock:
+                self.misses += 1
+            pixels = np.ascontiguousarray(decode())
+            self._store(content_hash, pixels)
+            with self._lock:
+                self._decoding.pop(content_hash, None)
+        self.trim(keep=content_hash)
+        array = self._load(content_hash)
+        return array if array is not None else pixels
+
+    def _store(self, content_hash, pixels):
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pixels, allow_pickle=False)
+            os.replace(temp_path, self.path(content_hash))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _entries(self):
+        """(mtime, size, path) of every cached array, oldest first"""
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def trim(self, keep=None):
+        """Delete least recently used arrays until the folder fits max_bytes"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        keep_path = self.path(keep) if keep else None
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Still mapped on a platform that refuses to delete it (Windows)
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'evictions': evictions,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
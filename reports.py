@@ -0,0 +1,215 @@
+"""PDF reports: the two archived study PDFs followed by a results page.
+
+Everything that does not depend on the result is built once: the paragraph
+styles, the static part of the results page (title and explanatory text)
+and, per PDF study, the concatenation of its two source PDFs. A request
+only renders the small overlay with the prediction, risk message, study
+name and date, stamps it onto the template page and appends that page to
+the merged sources with an incremental update, so the source pages are
+never parsed or rewritten again. Finished reports are named after the
+study and the result, so asking for the same report twice returns the
+existing file.
+
+pypdf and ReportLab are imported on first use, so importing this module (and
+so the web app) stays cheap for workers that never render a report.
+"""
+import functools
+import hashlib
+import os
+import tempfile
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+from telemetry import span
+
+
+# Bump whenever the results page layout changes, so cached reports are rebuilt
+REPORT_TEMPLATE_VERSION = 1
+
+TITLE = "Reporte de Análisis DICOM"
+EXPLANATION = ("Este informe ha sido generado automáticamente basándose en los resultados "
+               "del procesamiento de las imágenes DICOM.")
+HIGH_RISK_MESSAGE = 'ALTO RIESGO'
+
+INCH = 72.0  # PDF points
+PAGE_WIDTH, PAGE_HEIGHT = 8.5 * INCH, 11 * INCH  # US letter
+MARGIN = INCH
+
+
+@functools.lru_cache(maxsize=None)
+def report_styles():
+    """Paragraph styles for the results page, derived once from the sample sheet.
+
+    Each style is its own ParagraphStyle, so nothing in the shared sample
+    sheet is modified.
+    """
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+
+    sample = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle('ReportTitle', parent=sample['h1'], alignment=TA_CENTER),
+        'prediction': ParagraphStyle('ReportPrediction', parent=sample['Normal'], fontSize=18, leading=22,
+                                     alignment=TA_CENTER),
+        'risk': ParagraphStyle('ReportRisk', parent=sample['Normal'], fontSize=24, leading=30,
+                               alignment=TA_CENTER),
+        'body': ParagraphStyle('ReportBody', parent=sample['Normal'], alignment=TA_CENTER),
+    }
+
+
+def _page_blocks(percentage, risk_message, study_name, generated_at):
+    """Results page top-down as (static?, style, text) paragraphs and float spacers.
+
+    The prediction and risk lines are a single line each, so the static
+    explanation below them sits at the same height for every result.
+    """
+    risk_color = 'red' if risk_message == HIGH_RISK_MESSAGE else 'green'
+    return [
+        (True, 'title', TITLE),
+        0.2 * INCH,
+        (False, 'prediction', f"Predicción: <font color='blue'><b>{percentage}%</b></font>"),
+        0.2 * INCH,
+        (False, 'risk', f"<font color='{risk_color}'><b>{risk_message}</b></font>"),
+        0.5 * INCH,
+        (True, 'body', EXPLANATION),
+        0.2 * INCH,
+        (False, 'body', f"Estudio original: {study_name}"),
+        0.2 * INCH,
+        (False, 'body', f"Fecha de generación del reporte: {generated_at:%Y-%m-%d %H:%M:%S}"),
+    ]
+
+
+def _render_page(blocks, static):
+    """One letter page with only the static (or only the dynamic) blocks drawn"""
+    from reportlab.pdfgen import canvas
+    from reportlab.platypus import Paragraph
+
+    styles = report_styles()
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=(PAGE_WIDTH, PAGE_HEIGHT))
+    width = PAGE_WIDTH - 2 * MARGIN
+    y = PAGE_HEIGHT - MARGIN
+    for block in blocks:
+        if isinstance(block, float):
+            y -= block
+            continue
+        is_static, style, text = block
+        paragraph = Paragraph(text, styles[style])
+        _, height = paragraph.wrap(width, y - MARGIN)
+        if is_static == static:
+            paragraph.drawOn(pdf, MARGIN, y - height)
+        y -= height
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=1)
+def template_page_bytes():
+    """The static part of the results page, rendered once per process"""
+    return _render_page(_page_blocks('0', HIGH_RISK_MESSAGE, '', datetime.now()), static=True)
+
+
+def results_page(percentage, risk_message, study_name, generated_at=None):
+    """The results page: the cached template with this result stamped on top"""
+    from pypdf import PdfReader
+
+    blocks = _page_blocks(percentage, risk_message, study_name, generated_at or datetime.now())
+    page = PdfReader(BytesIO(template_page_bytes())).pages[0]
+    page.merge_page(PdfReader(BytesIO(_render_page(blocks, static=False))).pages[0])
+    return page
+
+
+def _write_atomic(path, write):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def merged_sources(source_paths, cache_folder, study_id):
+    """Path of the concatenated source PDFs for a study, merging them on first use"""
+    path = os.path.join(cache_folder, f'sources_{study_id}.pdf')
+    if not os.path.exists(path):
+        from pypdf import PdfWriter
+        with span('pdf_merge'):
+            writer = PdfWriter()
+            for source in source_paths:
+                writer.append(source)
+            _write_atomic(path, writer.write)
+    else:
+        # Mark it as used, so storage retention counts from the last report
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return path
+
+
+def report_filename(study_id, percentage, risk_message):
+    """Deterministic report name for a study and result"""
+    key = f'{REPORT_TEMPLATE_VERSION}|{study_id}|{percentage}|{risk_message}'
+    return f"Reporte_{study_id}_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.pdf"
+
+
+def build_report(study_id, study_name, source_paths, percentage, risk_message, reports_folder, cache_folder):
+    """Write (or reuse) the report for a PDFStudy and result; returns (filename, cached).
+
+    Takes plain values only, so it can run in a worker process.
+    """
+    filename = report_filename(study_id, percentage, risk_message)
+    path = os.path.join(reports_folder, filename)
+    if os.path.exists(path):
+        return filename, True
+
+    from pypdf import PdfWriter
+    with span('report_render'):
+        page = results_page(percentage, risk_message, study_name)
+    sources = merged_sources(source_paths, cache_folder, study_id)
+    with span('pdf_merge'):
+        writer = PdfWriter(sources, incremental=True)
+        writer.add_page(page)
+        _write_atomic(path, writer.write)
+    return filename, False
+
+
+class _ChunkBuffer:
+    """Write-only sink for zipfile that hands back what was written since the last call"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive chunk by chunk as (name, path or bytes) entries arrive.
+
+    The output is never seeked, so each member is sent as soon as it is
+    added; PDFs are stored without recompression.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, content in entries:
+            if isinstance(content, bytes):
+                archive.writestr(name, content)
+            else:
+                archive.write(content, name)
+            yield buffer.take()
+    yield buffer.take()
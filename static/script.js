@@ -22,6 +22,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const pdf1Input = document.getElementById('pdf1Input'); // Get reference to PDF 1 input
     const pdf2Input = document.getElementById('pdf2Input'); // Get reference to PDF 2 input
 
+    // Study session returned by the server: groups the DICOMs and PDFs of one examination
+    let currentStudySessionId = null;
+    let currentSessionHasDicoms = false;
+
     if (pdfUploadForm) {
         pdfUploadForm.addEventListener('submit', async (event) => {
             event.preventDefault(); // <--- THIS IS THE KEY: Prevents the default form submission (page reload)
@@ -30,6 +34,9 @@ document.addEventListener('DOMContentLoaded', () => {
             pdfUploadStatus.style.color = '#366699'; // Indicating processing
 
             const formData = new FormData(pdfUploadForm); // Automatically collects all form fields, including files
+            if (currentStudySessionId) {
+                formData.append('study_session_id', currentStudySessionId);
+            }
 
             try {
                 const response = await fetch('/upload_pdf', {
@@ -45,6 +52,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 const data = await response.json(); // Parse the JSON response from your Flask backend
 
                 if (data.success) {
+                    // The server starts a new session when the current one already has PDFs
+                    if (data.study_session_id !== currentStudySessionId) {
+                        currentSessionHasDicoms = false;
+                    }
+                    currentStudySessionId = data.study_session_id;
                     pdfUploadStatus.textContent = data.message;
                     pdfUploadStatus.style.color = 'green';
                     // Clear the file inputs after successful upload for a cleaner UI
@@ -132,6 +144,11 @@ document.addEventListener('DOMContentLoaded', () => {
         for (const file of files) {
             formData.append('file', file);
         }
+        // A new set of DICOMs starts a new study session, unless the current
+        // one only has PDFs so far
+        if (currentStudySessionId && !currentSessionHasDicoms) {
+            formData.append('study_session_id', currentStudySessionId);
+        }
 
         uploadStatus.textContent = 'Uploading...';
         uploadStatus.style.color = '#366699';
@@ -150,9 +167,11 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .then(data => {
             if (data.success) {
+                currentStudySessionId = data.study_session_id;
+                currentSessionHasDicoms = true;
                 uploadStatus.textContent = `Uploaded ${data.uploaded_files.length} file(s)`;
                 uploadStatus.style.color = 'green';
-                displayPreviews(data.previews, data.uploaded_files);
+                displayPreviews(data.previews, data.uploaded_files, data.tiles || []);
 
                 if (data.metadata && data.metadata.length > 0) {
                     updateMetadataDisplay(data.metadata[0]);
@@ -175,7 +194,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Core Function for Displaying Previews (no changes here) ---
-    function displayPreviews(previews, filenames) {
+    function displayPreviews(previews, filenames, tiles = []) {
         const planes = document.querySelectorAll('.planes .plane');
         if (!planes.length) {
             console.warn("No .plane elements found in DOM");
@@ -191,6 +210,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 const img = document.createElement('img');
                 img.src = `/previews/${preview}`;
                 img.className = 'preview-image';
+                if (tiles[index]) {
+                    // Full-resolution pan/zoom from the tile server
+                    img.classList.add('zoomable');
+                    img.title = 'Click to zoom';
+                    img.addEventListener('click', () => openTileViewer(tiles[index]));
+                }
                 planes[index].appendChild(img);
             } else {
                 const errorMsg = document.createElement('div');
@@ -201,6 +226,137 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // --- Zoomable viewer backed by /tiles/<study>/<image>/<z>/<x>/<y>.png ---
+    async function openTileViewer(tileBase) {
+        const response = await fetch(`${tileBase}/info`);
+        const info = await response.json();
+        if (!info.success) {
+            uploadStatus.textContent = `Viewer error: ${info.error || 'Unknown error'}`;
+            uploadStatus.style.color = 'red';
+            return;
+        }
+
+        const overlay = document.createElement('div');
+        overlay.className = 'tile-viewer';
+        overlay.innerHTML = `
+            <div class="tile-viewer__controls">
+                ${info.windowable ? `
+                <label>Nivel <input type="number" class="tile-level" value="${Math.round(info.window_center)}"></label>
+                <label>Ventana <input type="number" class="tile-window" min="1" value="${Math.round(info.window_width)}"></label>
+                <button class="tile-reset">Restablecer</button>` : ''}
+                <button class="tile-close">Cerrar</button>
+            </div>
+            <div class="tile-viewer__viewport"><div class="tile-viewer__stage"></div></div>`;
+        document.body.appendChild(overlay);
+
+        const viewport = overlay.querySelector('.tile-viewer__viewport');
+        const stage = overlay.querySelector('.tile-viewer__stage');
+        const levelInput = overlay.querySelector('.tile-level');
+        const windowInput = overlay.querySelector('.tile-window');
+        const size = info.tile_size;
+        let windowQuery = '';
+        let tileImages = new Map();
+
+        // Start at the largest level that fits the viewport, centred
+        const levelSize = z => {
+            const factor = 2 ** (info.max_zoom - z);
+            return [Math.ceil(info.width / factor), Math.ceil(info.height / factor)];
+        };
+        let zoom = 0;
+        while (zoom < info.max_zoom) {
+            const [w, h] = levelSize(zoom + 1);
+            if (w > viewport.clientWidth || h > viewport.clientHeight) break;
+            zoom++;
+        }
+        let [levelWidth, levelHeight] = levelSize(zoom);
+        let offsetX = (viewport.clientWidth - levelWidth) / 2;
+        let offsetY = (viewport.clientHeight - levelHeight) / 2;
+
+        function render() {
+            [levelWidth, levelHeight] = levelSize(zoom);
+            stage.style.transform = `translate(${offsetX}px, ${offsetY}px)`;
+
+            // Only the tiles that intersect the viewport are requested
+            const firstX = Math.max(0, Math.floor(-offsetX / size));
+            const firstY = Math.max(0, Math.floor(-offsetY / size));
+            const lastX = Math.min(Math.ceil(levelWidth / size), Math.ceil((viewport.clientWidth - offsetX) / size)) - 1;
+            const lastY = Math.min(Math.ceil(levelHeight / size), Math.ceil((viewport.clientHeight - offsetY) / size)) - 1;
+
+            const wanted = new Map();
+            for (let y = firstY; y <= lastY; y++) {
+                for (let x = firstX; x <= lastX; x++) {
+                    const src = `${tileBase}/${zoom}/${x}/${y}.png${windowQuery}`;
+                    let img = tileImages.get(src);
+                    if (!img) {
+                        img = document.createElement('img');
+                        img.src = src;
+                        img.style.left = `${x * size}px`;
+                        img.style.top = `${y * size}px`;
+                        img.draggable = false;
+                        stage.appendChild(img);
+                    }
+                    wanted.set(src, img);
+                }
+            }
+            tileImages.forEach((img, src) => { if (!wanted.has(src)) img.remove(); });
+            tileImages = wanted;
+        }
+
+        viewport.addEventListener('wheel', event => {
+            event.preventDefault();
+            const next = zoom + (event.deltaY < 0 ? 1 : -1);
+            if (next < 0 || next > info.max_zoom) return;
+            // Keep the point under the cursor fixed while changing level
+            const rect = viewport.getBoundingClientRect();
+            const px = event.clientX - rect.left;
+            const py = event.clientY - rect.top;
+            const factor = next > zoom ? 2 : 0.5;
+            offsetX = px - (px - offsetX) * factor;
+            offsetY = py - (py - offsetY) * factor;
+            zoom = next;
+            render();
+        }, { passive: false });
+
+        let dragStart = null;
+        viewport.addEventListener('mousedown', event => {
+            dragStart = { x: event.clientX - offsetX, y: event.clientY - offsetY };
+        });
+        const onMove = event => {
+            if (!dragStart) return;
+            offsetX = event.clientX - dragStart.x;
+            offsetY = event.clientY - dragStart.y;
+            render();
+        };
+        const onUp = () => { dragStart = null; };
+        window.addEventListener('mousemove', onMove);
+        window.addEventListener('mouseup', onUp);
+
+        function applyWindow() {
+            const level = parseFloat(levelInput.value);
+            const width = parseFloat(windowInput.value);
+            windowQuery = (isNaN(level) || isNaN(width)) ? '' : `?level=${level}&window=${width}`;
+            render();
+        }
+        if (levelInput) {
+            levelInput.addEventListener('change', applyWindow);
+            windowInput.addEventListener('change', applyWindow);
+            overlay.querySelector('.tile-reset').addEventListener('click', () => {
+                levelInput.value = Math.round(info.window_center);
+                windowInput.value = Math.round(info.window_width);
+                windowQuery = '';
+                render();
+            });
+        }
+
+        overlay.querySelector('.tile-close').addEventListener('click', () => {
+            window.removeEventListener('mousemove', onMove);
+            window.removeEventListener('mouseup', onUp);
+            overlay.remove();
+        });
+
+        render();
+    }
+
     // --- Separate Function for Processing Recent DICOMs ---
     async function handleProcessRecentDicoms() {
         uploadStatus.textContent = 'Processing recent DICOMs...';
@@ -214,7 +370,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/process_recent_dicoms', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({})
+                body: JSON.stringify({ study_session_id: currentStudySessionId })
             });
 
             if (!response.ok) {
@@ -222,7 +378,13 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(`Server responded with status ${response.status}: ${errorText}`);
             }
 
-            const data = await response.json();
+            let data = await response.json();
+
+            // Inference runs as a background job on the server: wait for its result
+            if (data.success && data.job_id) {
+                uploadStatus.textContent = 'Waiting for Mirai results...';
+                data = await waitForJob(data.status_url);
+            }
 
             if (data.success && data.target_response && data.target_response.data && data.target_response.data.predictions) {
                 uploadStatus.textContent = `Processing successful!`;
@@ -278,6 +440,23 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Poll /jobs/<id> until the job finishes and return its result payload
+    async function waitForJob(statusUrl, intervalMs = 1000) {
+        while (true) {
+            const response = await fetch(statusUrl);
+            if (!response.ok) {
+                const errorText = await response.text();
+                throw new Error(`Server responded with status ${response.status}: ${errorText}`);
+            }
+
+            const job = await response.json();
+            if (job.status === 'done' || job.status === 'failed') {
+                return job.result || { success: false, error: `Job ${job.status} without result` };
+            }
+            await new Promise(resolve => setTimeout(resolve, intervalMs));
+        }
+    }
+
     // NEW FUNCTION: Client-side logic to trigger PDF generation
     async function generateReportPDF(percentage, riskMessage) {
         if (percentage === null || riskMessage === null) {
@@ -292,7 +471,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/generate_report_pdf', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ percentage: percentage, riskMessage: riskMessage })
+                body: JSON.stringify({ percentage: percentage, riskMessage: riskMessage, study_session_id: currentStudySessionId })
             });
 
             if (!response.ok) {
@@ -300,7 +479,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(`Server responded with status ${response.status}: ${errorText}`);
             }
 
-            const data = await response.json();
+            let data = await response.json();
+
+            // Reports that are not cached yet are rendered as a background job
+            if (data.success && data.job_id) {
+                data = await waitForJob(data.status_url, 500);
+            }
 
             if (data.success && data.report_url) {
                 uploadStatus.textContent = 'PDF report generated successfully!';
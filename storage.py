@@ -0,0 +1,430 @@
+"""Lifecycle of stored files: deduplication, compression and retention.
+
+Uploaded DICOMs and archived PDFs are content-addressed (<sha256>.<ext>,
+see uploads.py) and previews are named after their DICOM's hash, so a
+file uploaded many times is stored once. StorageGC keeps the folders from
+growing forever. Each pass does a bounded amount of work on a background
+thread, so request threads never wait for it:
+
+- files no database row refers to (failed uploads, previews and tile
+  pyramids of removed studies) are deleted once they are older than a
+  grace period, as are .part files left by interrupted writes. Uploads
+  and archives with pre-content-addressing names are never deleted;
+- derived artifacts (reports, merged report sources, tile pyramids) are
+  evicted when unused for their retention period and rebuilt on the next
+  request;
+- identical files, e.g. previews stored under per-upload names before,
+  are replaced by hard links to one copy;
+- optionally, uploaded DICOMs in an uncompressed transfer syntax are
+  rewritten as Deflated Explicit VR Little Endian once they are a few
+  days old. This is lossless, the result is still a DICOM file pydicom
+  reads directly, and the pixel data is compared before the original is
+  replaced. inflated_paths() gives uncompressed copies to consumers that
+  may not read it (the Mirai container).
+
+One process runs a pass at a time (a lock file in the upload folder).
+Totals and per-file compression savings are kept in a small JSON ledger
+next to it.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import pydicom
+from pydicom.filereader import read_file_meta_info
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+import telemetry
+from ingest import CONTENT_ADDRESSED
+
+LEDGER_NAME = '.storage.json'
+LOCK_NAME = '.storage.lock'
+LOCK_STALE_AFTER = 3600  # Seconds before a lock left by a crashed process is ignored
+HASH_CHUNK_SIZE = 1024 * 1024
+REPORT_SOURCES = re.compile(r'sources_(\d+)\.pdf')
+COMPRESSIBLE_SYNTAXES = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+PYDICOM_MAJOR = int(pydicom.__version__.split('.')[0])
+COMPRESS_ATTEMPTS = 3  # Passes that may fail to compress a file before it is left alone
+# Folders whose duplicate files are hard-linked (pixel and tile caches are keyed by hash already)
+DEDUP_KINDS = ('uploads', 'archives', 'previews', 'reports')
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _files(folder):
+    """DirEntry of every regular file in folder (not recursive), skipping our own dot-files"""
+    try:
+        with os.scandir(folder) as it:
+            return [entry for entry in it if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.')]
+    except FileNotFoundError:
+        return []
+
+
+def _tree_size(path):
+    """(apparent bytes, bytes of distinct inodes, file count) under path"""
+    apparent, inodes, count = 0, {}, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            apparent += stat.st_size
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+            count += 1
+    return apparent, sum(inodes.values()), count
+
+
+def _remove(path):
+    """Delete a file or folder; returns the bytes freed (0 if it was already gone)"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            size = _tree_size(path)[1]
+            shutil.rmtree(path, ignore_errors=True)
+            return size
+        stat = os.lstat(path)
+        os.remove(path)
+        # A hard-linked copy frees nothing until its last link goes
+        return stat.st_size if stat.st_nlink == 1 else 0
+    except FileNotFoundError:
+        return 0
+
+
+def is_deflated(path):
+    try:
+        return read_file_meta_info(path).get('TransferSyntaxUID') == DeflatedExplicitVRLittleEndian
+    except Exception:
+        return False
+
+
+def _save_with_syntax(ds, path, transfer_syntax):
+    """Write ds as a DICOM file in another uncompressed (or deflated) little-endian transfer syntax"""
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    if PYDICOM_MAJOR < 3:
+        # pydicom 2 encodes by these flags, not by the transfer syntax
+        ds.is_implicit_VR = False
+        ds.is_little_endian = True
+        pydicom.dcmwrite(path, ds, write_like_original=False)
+    else:
+        pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+@contextlib.contextmanager
+def inflated_paths(paths):
+    """The given DICOM paths, with deflated files replaced by temporary uncompressed copies"""
+    temp_folder = None
+    result = []
+    try:
+        for path in paths:
+            if not is_deflated(path):
+                result.append(path)
+                continue
+            if temp_folder is None:
+                temp_folder = tempfile.mkdtemp(dir=os.path.dirname(path) or '.', suffix='.part')
+            copy_path = os.path.join(temp_folder, os.path.basename(path))
+            _save_with_syntax(pydicom.dcmread(path), copy_path, ExplicitVRLittleEndian)
+            result.append(copy_path)
+        yield result
+    finally:
+        if temp_folder is not None:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+class StorageGC:
+    """Incremental garbage collector for the app's storage folders.
+
+    folders maps 'uploads', 'archives', 'previews', 'reports',
+    'report_cache' and 'tile_cache' to paths. references() returns what
+    the database still points at: {'uploads': stored file names,
+    'archives': PDF file names, 'previews': preview names without
+    extension, 'report_sources': PDF study ids, 'images': content hashes}.
+    """
+
+    def __init__(self, folders, references, grace=3600, report_retention_days=30, tile_retention_days=7,
+                 compression=None, compress_after_days=7, batch=50):
+        self.folders = folders
+        self.references = references
+        self.grace = grace
+        self.report_retention = report_retention_days * 86400 if report_retention_days else None
+        self.tile_retention = tile_retention_days * 86400 if tile_retention_days else None
+        self.compression = compression
+        self.compress_after = compress_after_days * 86400
+        self.batch = batch
+        self._hashes = {}  # (dev, inode, size, mtime) -> sha256, so files are hashed once per process
+        self._thread = None
+        os.makedirs(folders['uploads'], exist_ok=True)
+        self.ledger_path = os.path.join(folders['uploads'], LEDGER_NAME)
+        self.lock_path = os.path.join(folders['uploads'], LOCK_NAME)
+
+    # --- ledger and lock ---
+
+    def _read_ledger(self):
+        try:
+            with open(self.ledger_path) as f:
+                ledger = json.load(f)
+        except (OSError, ValueError):
+            ledger = {}
+        ledger.setdefault('compressed', {})  # file name -> [original bytes, stored bytes]
+        ledger.setdefault('not_compressible', [])
+        ledger.setdefault('compress_errors', {})  # file name -> [failed attempts, last error]
+        ledger.setdefault('totals', {'passes': 0, 'removed_files': 0, 'freed_bytes': 0, 'linked_files': 0})
+        return ledger
+
+    def _write_ledger(self, ledger):
+        fd, temp_path = tempfile.mkstemp(dir=self.folders['uploads'], suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(ledger, f)
+        os.replace(temp_path, self.ledger_path)
+
+    @contextlib.contextmanager
+    def _pass_lock(self):
+        """Yields True if this process got the lock, False if another pass is running"""
+        try:
+            if time.time() - os.path.getmtime(self.lock_path) > LOCK_STALE_AFTER:
+                os.remove(self.lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.lock_path)
+
+    # --- pass ---
+
+    def run_pass(self, batch=None):
+        """One collection pass; returns its summary, or None if another process is running one"""
+        batch = self.batch if batch is None else batch
+        with self._pass_lock() as locked:
+            if not locked:
+                return None
+            started = time.perf_counter()
+            ledger = self._read_ledger()
+            summary = {'removed_files': 0, 'freed_bytes': 0, 'linked_files': 0, 'compressed_files': 0}
+
+            refs = self.references()
+            now = time.time()
+            for path in self._expired(refs, now):
+                freed = _remove(path)
+                summary['removed_files'] += 1
+                summary['freed_bytes'] += freed
+            summary['linked_files'] = self._dedup(batch)
+            if self.compression == 'deflate':
+                summary['compressed_files'] = self._compress(ledger, now, batch)
+
+            # Forget compressed files that have since been deleted
+            uploads = {entry.name for entry in _files(self.folders['uploads'])}
+            ledger['compressed'] = {name: sizes for name, sizes in ledger['compressed'].items() if name in uploads}
+            ledger['not_compressible'] = [name for name in ledger['not_compressible'] if name in uploads]
+            ledger['compress_errors'] = {name: error for name, error in ledger['compress_errors'].items()
+                                         if name in uploads}
+            totals = ledger['totals']
+            totals['passes'] += 1
+            for key in ('removed_files', 'freed_bytes', 'linked_files'):
+                totals[key] += summary[key]
+            summary['duration_s'] = round(time.perf_counter() - started, 3)
+            ledger['last_pass'] = dict(summary, finished_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+            self._write_ledger(ledger)
+        if any(summary[key] for key in ('removed_files', 'linked_files', 'compressed_files')):
+            telemetry.log.info('storage gc pass', extra={'fields': summary})
+        return summary
+
+    def _expired(self, refs, now):
+        """Paths to delete: leftovers, orphans past the grace period and artifacts past retention"""
+        folders = self.folders
+
+        def older(stat_result, seconds):
+            return seconds is not None and now - stat_result.st_mtime > seconds
+
+        for kind in ('uploads', 'archives', 'previews', 'reports', 'report_cache'):
+            for entry in _files(folders[kind]):
+                stat = entry.stat(follow_symlinks=False)
+                if entry.name.endswith('.part'):
+                    if older(stat, self.grace):
+                        yield entry.path
+                elif kind in ('uploads', 'archives'):
+                    if (CONTENT_ADDRESSED.fullmatch(entry.name) and entry.name not in refs[kind]
+                            and older(stat, self.grace)):
+                        yield entry.path
+                elif kind == 'previews':
+                    stem = os.path.splitext(entry.name)[0]
+                    base = stem.rsplit('_', 1)[0] if stem.endswith(('_thumb', '_full')) else stem
+                    if base not in refs['previews'] and older(stat, self.grace):
+                        yield entry.path
+                elif kind == 'reports':
+                    if older(stat, self.report_retention):
+                        yield entry.path
+                else:
+                    match = REPORT_SOURCES.fullmatch(entry.name)
+                    orphan = match is not None and int(match.group(1)) not in refs['report_sources']
+                    if (orphan and older(stat, self.grace)) or older(stat, self.report_retention):
+                        yield entry.path
+
+        # Leftover temporary folders of inflated_paths()
+        with contextlib.suppress(FileNotFoundError), os.scandir(folders['uploads']) as it:
+            for entry in it:
+                if entry.is_dir() and entry.name.endswith('.part') and older(entry.stat(), self.grace):
+                    yield entry.path
+
+        with contextlib.suppress(FileNotFoundError), os.scandir(folders['tile_cache']) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if (entry.name not in refs['images'] and older(stat, self.grace)) or older(stat, self.tile_retention):
+                    yield entry.path
+
+    def _dedup(self, batch):
+        """Hard-link identical files within each folder; hashes at most batch new files per pass"""
+        linked = 0
+        budget = batch
+        for kind in DEDUP_KINDS:
+            by_size = {}
+            for entry in _files(self.folders[kind]):
+                if entry.name.endswith('.part'):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                by_size.setdefault(stat.st_size, []).append((entry.path, stat))
+
+            for size, files in by_size.items():
+                if size == 0 or len({(stat.st_dev, stat.st_ino) for _, stat in files}) < 2:
+                    continue
+                canonical = {}  # sha256 -> (path, stat) kept
+                for path, stat in sorted(files, key=lambda item: item[1].st_mtime):
+                    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    sha = self._hashes.get(key)
+                    if sha is None:
+                        if budget <= 0:
+                            continue
+                        budget -= 1
+                        try:
+                            sha = self._hashes[key] = _hash_file(path)
+                        except OSError:
+                            continue
+                    keep = canonical.setdefault(sha, (path, stat))
+                    if keep[0] == path or (keep[1].st_dev, keep[1].st_ino) == (stat.st_dev, stat.st_ino):
+                        continue
+                    temp_path = f'{path}.{os.getpid()}.link.part'
+                    try:
+                        os.link(keep[0], temp_path)
+                        os.replace(temp_path, path)
+                        linked += 1
+                    except OSError:
+                        with contextlib.suppress(OSError):
+                            os.remove(temp_path)
+        return linked
+
+    def _compress(self, ledger, now, batch):
+        """Try to deflate up to batch old uncompressed DICOMs in the upload folder; returns how many were"""
+        done = attempts = 0
+        errors = ledger['compress_errors']
+        skip = set(ledger['compressed']) | set(ledger['not_compressible'])
+        skip.update(name for name, (failures, _) in errors.items() if failures >= COMPRESS_ATTEMPTS)
+        for entry in _files(self.folders['uploads']):
+            if attempts >= batch:
+                break
+            if entry.name in skip or entry.name.endswith('.part'):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if now - stat.st_mtime < self.compress_after or stat.st_nlink > 1:
+                continue
+            attempts += 1
+            try:
+                stored = self._deflate(entry.path, stat)
+            except Exception as e:
+                # Tried again on later passes, up to COMPRESS_ATTEMPTS times; only "not worth it" is final
+                telemetry.log.warning(f'Could not compress {entry.name}: {e}')
+                errors[entry.name] = [errors.get(entry.name, [0])[0] + 1, str(e)]
+                continue
+            errors.pop(entry.name, None)
+            if stored is None:
+                ledger['not_compressible'].append(entry.name)
+            else:
+                ledger['compressed'][entry.name] = [stat.st_size, stored]
+                done += 1
+        return done
+
+    def _deflate(self, path, stat):
+        """Rewrite path with the deflated transfer syntax; returns the new size, or None if not worth it"""
+        meta = read_file_meta_info(path)
+        if meta.get('TransferSyntaxUID') not in COMPRESSIBLE_SYNTAXES:
+            return None
+        ds = pydicom.dcmread(path)
+        original_pixels = ds.get('PixelData')
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        os.close(fd)
+        try:
+            _save_with_syntax(ds, temp_path, DeflatedExplicitVRLittleEndian)
+            check = pydicom.dcmread(temp_path)
+            if check.get('PixelData') != original_pixels or len(check) != len(ds):
+                raise ValueError('deflated copy does not match the original')
+            stored = os.path.getsize(temp_path)
+            if stored >= stat.st_size:
+                os.remove(temp_path)
+                return None
+            # Keep the original mtime so retention and compress_after still count from the upload
+            os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            os.replace(temp_path, path)
+            return stored
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+    # --- background thread and stats ---
+
+    def start(self, interval):
+        """Run a pass every interval seconds on a daemon thread (once per process)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, args=(interval,), name='storage-gc', daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.run_pass()
+            except Exception as e:
+                telemetry.log.warning(f'Storage GC pass failed: {e}')
+
+    def stats(self):
+        """Space used per folder and what deduplication and compression save"""
+        folders = {}
+        linked_saved = 0
+        for kind, folder in self.folders.items():
+            apparent, stored, count = _tree_size(folder)
+            folders[kind] = {'files': count, 'bytes': stored}
+            if kind in DEDUP_KINDS:
+                linked_saved += apparent - stored
+        ledger = self._read_ledger()
+        original = sum(sizes[0] for sizes in ledger['compressed'].values())
+        stored = sum(sizes[1] for sizes in ledger['compressed'].values())
+        return {
+            'folders': folders,
+            'dedup': {'saved_bytes': linked_saved},
+            'compression': {'method': self.compression, 'files': len(ledger['compressed']),
+                            'original_bytes': original, 'stored_bytes': stored, 'saved_bytes': original - stored,
+                            'errors': ledger['compress_errors']},
+            'saved_bytes': linked_saved + original - stored,
+            'totals': ledger['totals'],
+            'last_pass': ledger.get('last_pass'),
+        }
@@ -0,0 +1,389 @@
+"""Stage timings, Prometheus histograms, request trace ids and opt-in profiling.
+
+span('pixel_decode') times one pipeline stage. Every span goes into a
+latency histogram of this process, and into the span list of the current
+trace (one per request or job), which is written with the request's
+structured log line.
+
+Uploads and reports run partly in worker processes, and gunicorn runs
+several workers, so each process with a folder configured writes its
+histograms to <folder>/<pid>.json every few seconds. render() adds those
+files to the live numbers of the process answering /metrics. Files of
+processes that have exited are folded into dead.json by compact(), so
+counters never go backwards.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Upper bounds in seconds: from a cached tile read up to a slow inference on CPU
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_METRIC = 'mirai_stage_duration_seconds'
+REQUEST_METRIC = 'mirai_http_request_duration_seconds'
+HELP = {
+    STAGE_METRIC: 'Time spent in each pipeline stage.',
+    REQUEST_METRIC: 'Time until the response headers are ready, by route and status.',
+}
+DEAD_FILE = 'dead.json'
+# Incoming X-Request-ID values are reused as trace ids (and profile file names) only if they look like this
+TRACE_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+log = logging.getLogger('mirai')
+
+
+class Histograms:
+    """Latency histograms keyed by (metric name, sorted label pairs)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # key -> [count per bucket (last one is +Inf)..., sum]
+        self.dirty = False
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += seconds
+            self.dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, dict(labels), list(series)] for (name, labels), series in self._series.items()]
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, series in snapshot:
+                key = (name, tuple(sorted(labels.items())))
+                current = self._series.get(key)
+                if current is None or len(current) != len(series):
+                    self._series[key] = list(series)
+                else:
+                    self._series[key] = [a + b for a, b in zip(current, series)]
+
+
+_histograms = Histograms()
+_folder = None
+_flush_interval = 10.0
+_pid = os.getpid()
+_flusher = None
+_state_lock = threading.Lock()
+
+
+def configure(folder, flush_interval=10.0):
+    """Share this process's histograms through folder (also the process pool initializer)"""
+    global _folder, _flush_interval
+    os.makedirs(folder, exist_ok=True)
+    _folder = os.path.abspath(folder)
+    _flush_interval = flush_interval
+    _local()
+
+
+def _local():
+    """Histograms of this process; a forked child starts empty with its own flusher"""
+    global _histograms, _pid, _flusher
+    if _pid != os.getpid() or (_folder is not None and _flusher is None):
+        with _state_lock:
+            if _pid != os.getpid():
+                _histograms = Histograms()
+                _pid = os.getpid()
+                _flusher = None
+            if _folder is not None and _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name='telemetry-flush', daemon=True)
+                _flusher.start()
+    return _histograms
+
+
+def _flush_loop():
+    while True:
+        time.sleep(_flush_interval)
+        try:
+            flush()
+        except OSError as e:
+            log.warning('Could not write metrics: %s', e)
+
+
+def _write_json(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def flush():
+    """Write this process's histograms to <folder>/<pid>.json if they changed"""
+    histograms = _local()
+    if _folder is None or not histograms.dirty:
+        return
+    histograms.dirty = False
+    _write_json(os.path.join(_folder, f'{os.getpid()}.json'), histograms.snapshot())
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _pid_files():
+    """(pid, path) of every per-process file in the folder"""
+    if _folder is None:
+        return []
+    files = []
+    with os.scandir(_folder) as it:
+        for entry in it:
+            stem, ext = os.path.splitext(entry.name)
+            if ext == '.json' and stem.isdigit():
+                files.append((int(stem), entry.path))
+    return files
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def compact():
+    """Fold the files of exited processes into dead.json.
+
+    Skipped on Windows, where os.kill() cannot probe a process, and when
+    another process is already compacting.
+    """
+    if _folder is None or os.name == 'nt':
+        return
+    lock_path = os.path.join(_folder, 'compact.lock')
+    try:
+        if time.time() - os.path.getmtime(lock_path) > 60:
+            os.remove(lock_path)  # left behind by a crashed process
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+    try:
+        dead = [(pid, path) for pid, path in _pid_files() if pid != os.getpid() and not _alive(pid)]
+        if not dead:
+            return
+        merged = Histograms()
+        dead_path = os.path.join(_folder, DEAD_FILE)
+        merged.merge(_read_json(dead_path))
+        for _, path in dead:
+            merged.merge(_read_json(path))
+        _write_json(dead_path, merged.snapshot())
+        for _, path in dead:
+            os.remove(path)
+    finally:
+        os.remove(lock_path)
+
+
+def observe(name, labels, seconds):
+    _local().observe(name, labels, seconds)
+    trace = _trace.get()
+    if trace is not None and name == STAGE_METRIC:
+        trace.spans.append((labels['stage'], seconds))
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time a pipeline stage (also when it raises)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(STAGE_METRIC, {'stage': stage}, time.perf_counter() - start)
+
+
+def collect():
+    """Histograms of every process sharing the folder, this one read live"""
+    total = Histograms()
+    total.merge(_local().snapshot())
+    if _folder is not None:
+        own = os.getpid()
+        for pid, path in _pid_files():
+            if pid != own:
+                total.merge(_read_json(path))
+        total.merge(_read_json(os.path.join(_folder, DEAD_FILE)))
+    return total
+
+
+def _label_text(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for key, value in sorted(labels.items()))
+
+
+def render():
+    """All histograms in the Prometheus text exposition format"""
+    by_name = {}
+    for name, labels, series in collect().snapshot():
+        by_name.setdefault(name, []).append((labels, series))
+
+    lines = []
+    for name in sorted(by_name):
+        lines.append(f'# HELP {name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, series in sorted(by_name[name], key=lambda item: sorted(item[0].items())):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{_label_text(dict(labels, le=le))}}} {cumulative}')
+            label_text = _label_text(labels)
+            lines.append(f'{name}_sum{{{label_text}}} {series[-1]}')
+            lines.append(f'{name}_count{{{label_text}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Traces ---
+
+class Trace:
+    def __init__(self, trace_id=None):
+        self.id = trace_id if trace_id and TRACE_ID_PATTERN.fullmatch(trace_id) else uuid.uuid4().hex
+        self.spans = []  # (stage, seconds), in the order they finished
+
+
+_trace = contextvars.ContextVar('mirai_trace', default=None)
+
+
+def start_trace(trace_id=None):
+    """Make a new trace current; returns the token for end_trace()"""
+    return _trace.set(Trace(trace_id))
+
+
+def end_trace(token):
+    _trace.reset(token)
+
+
+def current_trace():
+    return _trace.get()
+
+
+@contextlib.contextmanager
+def trace(trace_id=None):
+    """Run a block (e.g. a background job) under its own trace"""
+    token = start_trace(trace_id)
+    try:
+        yield _trace.get()
+    finally:
+        end_trace(token)
+
+
+def span_summary(spans):
+    """{stage: {'n': count, 'ms': total milliseconds}} for a log line"""
+    summary = {}
+    for stage, seconds in spans:
+        entry = summary.setdefault(stage, {'n': 0, 'ms': 0.0})
+        entry['n'] += 1
+        entry['ms'] += seconds * 1000
+    for entry in summary.values():
+        entry['ms'] = round(entry['ms'], 1)
+    return summary
+
+
+@contextlib.contextmanager
+def recorded_spans():
+    """Collect the spans of a block run outside the caller's trace (e.g. on a pool)"""
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace.spans
+    finally:
+        _trace.reset(token)
+
+
+def add_spans(spans):
+    """Attach spans recorded elsewhere to the current trace (not to the histograms again)"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.extend(spans)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the current trace id and any extra={'fields': {...}}"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        trace = _trace.get()
+        if trace is not None:
+            entry['trace_id'] = trace.id
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level='INFO'):
+    """Send the 'mirai' logger to stderr as JSON lines (once)"""
+    if not any(isinstance(handler.formatter, JsonFormatter) for handler in log.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+
+
+# --- Profiling ---
+
+def start_profile(kind):
+    """Start profiling the current thread with 'cprofile' or 'pyinstrument'; None if unavailable"""
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            return None
+        profiler = Profiler()
+        profiler.start()
+        return kind, profiler
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is active (only one at a time on Python 3.12+)
+        return None
+    return 'cprofile', profiler
+
+
+def stop_profile(handle, folder, name):
+    """Stop a profile from start_profile() and save it; returns the file name"""
+    kind, profiler = handle
+    os.makedirs(folder, exist_ok=True)
+    if kind == 'pyinstrument':
+        profiler.stop()
+        filename = f'{name}.html'
+        with open(os.path.join(folder, filename), 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        filename = f'{name}.prof'
+        profiler.dump_stats(os.path.join(folder, filename))
+    return filename
@@ -0,0 +1,134 @@
+"""Inference jobs against the stand-in model server, on a throwaway database.
+
+Run with: python -m unittest discover tests
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from test_model_client import FakeMirai  # noqa: E402
+
+_tmp = tempfile.mkdtemp(prefix='mirai-jobs-')
+# The engine is created when app is imported, so the database is chosen first
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+
+import app as mirai_app  # noqa: E402
+from jobs import JOB_DONE, JOB_FAILED  # noqa: E402
+from model_client import ModelClient  # noqa: E402
+from synthetic import make_dataset  # noqa: E402
+
+logging.getLogger('mirai').setLevel(logging.ERROR)
+
+
+def setUpModule():
+    mirai_app.create_app({key: os.path.join(_tmp, key.lower()) for key in (
+        'UPLOAD_FOLDER', 'PREVIEW_FOLDER', 'ARCHIVES_FOLDER', 'REPORTS_FOLDER', 'REPORT_CACHE_FOLDER',
+        'TILE_CACHE_FOLDER', 'PIXEL_CACHE_FOLDER', 'METRICS_FOLDER', 'PROFILE_FOLDER')})
+
+
+def tearDownModule():
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+class BarrierClient(ModelClient):
+    """Holds every request until `parties` of them arrived, so all of them miss the cache"""
+
+    def __init__(self, url, parties):
+        super().__init__([url], retries=0)
+        self.barrier = threading.Barrier(parties, timeout=10)
+
+    def post_files(self, paths, data=None):
+        self.barrier.wait()
+        return super().post_files(paths, data=data)
+
+
+class ConcurrentJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeMirai()
+        self.path = os.path.join(_tmp, f'{self.id()}.dcm')
+        make_dataset(rows=64, cols=64, seed=len(self.id())).save_as(self.path)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def submit(self, count):
+        with mirai_app.app.app_context():
+            jobs = [mirai_app.InferenceJob(id=f'{self.id()[-20:]}{n}', file_paths=json.dumps([self.path]))
+                    for n in range(count)]
+            mirai_app.db.session.add_all(jobs)
+            mirai_app.db.session.commit()
+            return [job.id for job in jobs]
+
+    def run_jobs(self, job_ids):
+        def run(job_id):
+            with mirai_app.app.app_context():
+                mirai_app.run_inference_job(job_id)
+
+        threads = [threading.Thread(target=run, args=(job_id,)) for job_id in job_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+
+        with mirai_app.app.app_context():
+            return [mirai_app.db.session.get(mirai_app.InferenceJob, job_id) for job_id in job_ids]
+
+    def test_identical_jobs_share_one_cache_entry(self):
+        job_ids = self.submit(2)
+        client = BarrierClient(self.server.url, parties=2)
+        with mock.patch.object(mirai_app, 'get_model_client', return_value=client):
+            jobs = self.run_jobs(job_ids)
+
+        for job in jobs:
+            self.assertEqual(job.status, JOB_DONE, job.result)
+            self.assertEqual(json.loads(job.result)['cache'], 'miss')
+        self.assertEqual(self.server.requests, 2)
+        with mirai_app.app.app_context():
+            content_hash = mirai_app.get_parsed(self.path).content_hash
+            cache_key = mirai_app.inference_cache_key([content_hash])
+            self.assertEqual(mirai_app.InferenceCache.query.filter_by(cache_key=cache_key).count(), 1)
+
+    def test_failed_cache_write_keeps_the_prediction(self):
+        job_ids = self.submit(1)
+        client = ModelClient([self.server.url], retries=0)
+        failure = mirai_app.SQLAlchemyError('database is locked')
+        with mock.patch.object(mirai_app, 'get_model_client', return_value=client), \
+                mock.patch.object(mirai_app, 'store_cached_predictions', side_effect=failure):
+            job, = self.run_jobs(job_ids)
+
+        self.assertEqual(job.status, JOB_DONE, job.result)
+        self.assertEqual(len(json.loads(job.result)['target_response']['data']['predictions']), 5)
+
+    def test_failed_result_write_marks_the_job_failed(self):
+        job_ids = self.submit(1)
+        client = ModelClient([self.server.url], retries=0)
+        finish = mirai_app.finish_inference_job
+        calls = []
+
+        def fail_first_commit(job, result, status):
+            calls.append(status)
+            if len(calls) == 1:
+                job.result = json.dumps(result)
+                raise mirai_app.SQLAlchemyError('disk I/O error')
+            finish(job, result, status)
+
+        with mock.patch.object(mirai_app, 'get_model_client', return_value=client), \
+                mock.patch.object(mirai_app, 'finish_inference_job', side_effect=fail_first_commit):
+            job, = self.run_jobs(job_ids)
+
+        self.assertEqual(job.status, JOB_FAILED)
+        self.assertIn('disk I/O error', json.loads(job.result)['error'])
+        self.assertIsNotNone(job.finished_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""ModelClient against the stand-in model server (benchmarks/fake_mirai.py).
+
+Run with: python -m unittest discover tests
+"""
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from fake_mirai import create_fake_mirai  # noqa: E402
+from model_client import ModelClient, ModelUnavailable  # noqa: E402
+
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+
+class FakeMirai:
+    """A fake_mirai app served on a free local port from a background thread"""
+
+    def __init__(self, fail_rate=0.0):
+        self.app = create_fake_mirai(fail_rate=fail_rate)
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/dicom/files'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def requests(self):
+        return self.app.config['STATS']['requests']
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def closed_port_url():
+    """URL of a local port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}/dicom/files'
+
+
+class ModelClientTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        fd, self.dicom_path = tempfile.mkstemp(suffix='.dcm')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\0' * 128 + b'DICM')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        os.remove(self.dicom_path)
+
+    def serve(self, fail_rate=0.0):
+        server = FakeMirai(fail_rate)
+        self.servers.append(server)
+        return server
+
+    def client(self, endpoints, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        kwargs.setdefault('connect_timeout', 1.0)
+        kwargs.setdefault('read_timeout', 5.0)
+        return ModelClient(endpoints, **kwargs)
+
+    def post(self, client):
+        return client.post_files([self.dicom_path], data={'data': '{}'})
+
+    def test_round_robin(self):
+        first, second = self.serve(), self.serve()
+        client = self.client([first.url, second.url])
+        for _ in range(4):
+            self.assertEqual(self.post(client).status_code, 200)
+        self.assertEqual((first.requests, second.requests), (2, 2))
+
+    def test_retries_5xx_on_next_endpoint(self):
+        failing, healthy = self.serve(fail_rate=1.0), self.serve()
+        client = self.client([failing.url, healthy.url], failure_threshold=10)
+        response = self.post(client)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('predictions', response.json()['data'])
+        self.assertEqual((failing.requests, healthy.requests), (1, 1))
+
+    def test_retries_5xx_on_single_endpoint(self):
+        failing = self.serve(fail_rate=1.0)
+        client = self.client([failing.url], retries=2, failure_threshold=10)
+        with self.assertRaises(requests.exceptions.HTTPError) as raised:
+            self.post(client)
+        self.assertEqual(raised.exception.response.status_code, 500)
+        self.assertEqual(failing.requests, 3)
+
+    def test_fails_over_from_unreachable_endpoint(self):
+        healthy = self.serve()
+        client = self.client([closed_port_url(), healthy.url])
+        for _ in range(3):
+            self.assertEqual(self.post(client).status_code, 200)
+        self.assertEqual(healthy.requests, 3)
+
+    def test_4xx_is_not_retried(self):
+        server = self.serve()
+        client = self.client([server.url])
+        response = client.post_files([], data={'data': '{}'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(server.requests, 1)
+
+    def test_circuit_opens_and_fails_fast(self):
+        failing = self.serve(fail_rate=1.0)
+        client = self.client([failing.url], retries=0, failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                self.post(client)
+        self.assertEqual(client.status(), {failing.url: 'open'})
+
+        started = time.monotonic()
+        with self.assertRaises(ModelUnavailable):
+            self.post(client)
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(failing.requests, 2)
+
+    def test_half_open_trial_closes_circuit(self):
+        server = self.serve(fail_rate=1.0)
+        client = self.client([server.url], retries=0, failure_threshold=1, reset_timeout=0.2)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.post(client)
+        with self.assertRaises(ModelUnavailable):
+            self.post(client)
+
+        server.app.config['FAIL_RATE'] = 0.0
+        time.sleep(0.25)
+        self.assertEqual(self.post(client).status_code, 200)
+        self.assertEqual(client.status(), {server.url: 'closed'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""Windowing and downscaling of signed pixel data (previews and tile levels).
+
+Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+from pydicom.dataset import Dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preview import window_pixels  # noqa: E402
+from tiles import halve  # noqa: E402
+
+
+def signed_dataset():
+    ds = Dataset()
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.PixelRepresentation = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    return ds
+
+
+class SignedPixelsTest(unittest.TestCase):
+    def test_window_pixels_wide_int16_range(self):
+        pixels = np.linspace(-30000, 30000, 64 * 64).astype(np.int16).reshape(64, 64)
+        image = window_pixels(signed_dataset(), pixels)
+        self.assertEqual(image.dtype, np.uint8)
+        self.assertEqual((image.min(), image.max()), (0, 255))
+        # Windowing keeps the order of the stored values
+        self.assertTrue(np.all(np.diff(image.ravel().astype(np.int16)) >= 0))
+
+    def test_halve_negative_int16(self):
+        image = np.array([[-30000, -30000], [-30000, -29996]], dtype=np.int16)
+        self.assertEqual(halve(image).tolist(), [[-29999]])
+
+    def test_halve_uint16(self):
+        image = np.array([[65535, 65535, 1], [65535, 65535, 3]], dtype=np.uint16)
+        self.assertEqual(halve(image).tolist(), [[65535, 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Storage GC passes over throwaway folders: what is deleted, linked and deflated.
+
+The deflate round trip should pass on pydicom 2.x and 3.x alike.
+
+Run with: python -m unittest discover tests
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pydicom
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from storage import StorageGC, inflated_paths, is_deflated  # noqa: E402
+from synthetic import write_dicom  # noqa: E402
+from tiles import get_tile_source  # noqa: E402
+
+DAY = 86400
+KINDS = ('uploads', 'archives', 'previews', 'reports', 'report_cache', 'tile_cache')
+
+
+def sha(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='mirai-storage-')
+        self.folders = {kind: os.path.join(self.root, kind) for kind in KINDS}
+        for folder in self.folders.values():
+            os.makedirs(folder)
+        self.refs = {'uploads': set(), 'archives': set(), 'previews': set(), 'report_sources': set(), 'images': set()}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def gc(self, **kwargs):
+        return StorageGC(self.folders, lambda: self.refs, grace=3600, report_retention_days=30,
+                         tile_retention_days=7, **kwargs)
+
+    def put(self, kind, name, age=0, content=b'data'):
+        """Create a file (or a folder for tile_cache) last modified `age` seconds ago"""
+        path = os.path.join(self.folders[kind], name)
+        if kind == 'tile_cache':
+            os.makedirs(path)
+        else:
+            with open(path, 'wb') as f:
+                f.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+
+class ExpiryTest(StorageTestCase):
+    def test_orphans_past_grace_and_artifacts_past_retention_are_removed(self):
+        kept_upload, orphan_upload, new_orphan = sha('kept') + '.dcm', sha('orphan') + '.dcm', sha('new') + '.dcm'
+        self.refs.update(uploads={kept_upload}, previews={'kept'}, report_sources={1}, images={sha('tiles')})
+        keep = [
+            self.put('uploads', kept_upload, age=DAY),
+            self.put('uploads', new_orphan, age=60),  # Still within the grace period
+            self.put('uploads', 'IMG_0001.dcm', age=90 * DAY),  # Legacy name: never deleted
+            self.put('uploads', 'fresh.part', age=60),
+            self.put('archives', 'legacy_report.pdf', age=90 * DAY),
+            self.put('previews', 'kept.png', age=DAY),
+            self.put('previews', 'kept_thumb.png', age=DAY),
+            self.put('reports', 'report_recent.pdf', age=DAY),
+            self.put('report_cache', 'sources_1.pdf', age=DAY),
+            self.put('tile_cache', sha('tiles'), age=DAY),
+        ]
+        remove = [
+            self.put('uploads', orphan_upload, age=DAY),
+            self.put('uploads', 'stale.part', age=DAY),
+            self.put('archives', sha('archive') + '.pdf', age=DAY),
+            self.put('previews', 'gone_full.png', age=DAY),
+            self.put('reports', 'report_old.pdf', age=31 * DAY),
+            self.put('report_cache', 'sources_2.pdf', age=DAY),
+            self.put('tile_cache', sha('gone'), age=DAY),
+            self.put('tile_cache', sha('tiles-unused'), age=8 * DAY),
+        ]
+        self.refs['images'].add(sha('tiles-unused'))  # Referenced, but unused past retention
+
+        summary = self.gc().run_pass()
+
+        self.assertEqual(summary['removed_files'], len(remove))
+        for path in keep:
+            self.assertTrue(os.path.exists(path), path)
+        for path in remove:
+            self.assertFalse(os.path.exists(path), path)
+
+    def test_second_pass_waits_for_the_lock(self):
+        gc = self.gc()
+        with gc._pass_lock() as locked:
+            self.assertTrue(locked)
+            self.assertIsNone(gc.run_pass())
+
+
+class DedupTest(StorageTestCase):
+    def test_identical_files_become_hard_links(self):
+        self.refs['previews'] = {'first', 'second'}
+        first = self.put('previews', 'first.png', age=DAY, content=b'same preview')
+        second = self.put('previews', 'second.png', content=b'same preview')
+        other = self.put('previews', 'third.png', content=b'other preview')
+
+        summary = self.gc().run_pass()
+
+        self.assertEqual(summary['linked_files'], 1)
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(os.stat(first).st_nlink, 2)
+        self.assertEqual(os.stat(other).st_nlink, 1)
+        with open(second, 'rb') as f:
+            self.assertEqual(f.read(), b'same preview')
+        self.assertEqual(self.gc().stats()['dedup']['saved_bytes'], len(b'same preview'))
+
+
+class DeflateTest(StorageTestCase):
+    def test_deflate_round_trip(self):
+        name = sha('upload') + '.dcm'
+        self.refs['uploads'] = {name}
+        path = write_dicom(os.path.join(self.folders['uploads'], name), rows=128, cols=96,
+                           transfer_syntax='implicit')
+        original = pydicom.dcmread(path).pixel_array.copy()
+        mtime = time.time() - 8 * DAY
+        os.utime(path, (mtime, mtime))
+
+        gc = self.gc(compression='deflate', compress_after_days=7)
+        summary = gc.run_pass()
+
+        self.assertEqual(summary['compressed_files'], 1, f'pydicom {pydicom.__version__}')
+        self.assertTrue(is_deflated(path))
+        self.assertEqual(os.path.getmtime(path), mtime)
+        np.testing.assert_array_equal(pydicom.dcmread(path).pixel_array, original)
+        self.assertEqual(gc.stats()['compression']['files'], 1)
+
+        with inflated_paths([path]) as paths:
+            self.assertNotEqual(paths[0], path)
+            self.assertFalse(is_deflated(paths[0]))
+            np.testing.assert_array_equal(pydicom.dcmread(paths[0]).pixel_array, original)
+        self.assertFalse(os.path.exists(paths[0]))
+
+        # Already deflated: later passes leave it alone
+        self.assertEqual(gc.run_pass()['compressed_files'], 0)
+
+
+class TileSourceTest(StorageTestCase):
+    def test_removed_pyramid_is_rebuilt(self):
+        content_hash = sha('tile source')
+        path = write_dicom(os.path.join(self.folders['uploads'], content_hash + '.dcm'), rows=300, cols=200)
+        source = get_tile_source(path, content_hash, self.folders['tile_cache'])
+        self.assertEqual(source.info['width'], 200)
+
+        shutil.rmtree(source.folder)  # As the storage GC does with unused pyramids
+        rebuilt = get_tile_source(path, content_hash, self.folders['tile_cache'])
+
+        self.assertIsNot(rebuilt, source)
+        self.assertTrue(rebuilt.tile(0, 0, 0).startswith(b'\x89PNG'))
+        self.assertTrue(os.path.isdir(rebuilt.folder))
+
+
+if __name__ == '__main__':
+    unittest.main()
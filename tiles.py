@@ -0,0 +1,257 @@
+"""Zoomable PNG tiles for full-resolution DICOM images.
+
+Each image gets a folder <cache>/<content hash>/ that is filled lazily:
+
+- level_<z>.npy holds the pyramid level z, averaged 2x2 from level z + 1;
+  level 0 fits in one tile. The top zoom level is the decoded pixel array
+  itself, memory-mapped from the shared PixelCache (see pixel_cache.py),
+  so the DICOM is decoded once and a tile only reads the rows it needs.
+- tiles/<z>/<x>_<y>.png holds tiles rendered with the dataset's own VOI
+  LUT window.
+
+Tiles with a custom window/level are rendered on request from the
+memory-mapped level. For <=16 bit data the window is a lookup table over
+the stored value range, so one tile costs an index operation plus the PNG
+encode.
+"""
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pydicom
+from pydicom.pixel_data_handlers import apply_voi_lut
+
+from ingest import read_header
+from preview import _scale_to_uint8, encode_png, window_pixels
+from telemetry import span
+
+TILE_SIZE = 256
+
+
+class TileNotFound(LookupError):
+    """The requested zoom level or tile lies outside the image"""
+
+
+def _write_atomic(path, write):
+    """Write through write(file) to a temporary file, then rename it into place,
+    so concurrent readers never see (or memory-map) a partial file"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _save_npy(path, array):
+    _write_atomic(path, lambda f: np.save(f, array, allow_pickle=False))
+
+
+def halve(image):
+    """2x2 block average; odd edges repeat their last row/column"""
+    height, width = image.shape[:2]
+    if height % 2 or width % 2:
+        image = np.pad(image, [(0, height % 2), (0, width % 2)] + [(0, 0)] * (image.ndim - 2), mode='edge')
+    # Signed data is summed in a signed type, or negative values would wrap around
+    total = image[0::2, 0::2].astype(np.int32 if image.dtype.kind == 'i' else np.uint32)
+    total += image[1::2, 0::2]
+    total += image[0::2, 1::2]
+    total += image[1::2, 1::2]
+    total += 2
+    total //= 4
+    return total.astype(image.dtype)
+
+
+def window_lut(p_min, p_max, center, width, slope=1.0, intercept=0.0):
+    """uint8 lookup table over stored values p_min..p_max for a linear window (DICOM PS3.3 C.11.2.1.2)"""
+    values = np.arange(p_min, p_max + 1, dtype=np.float64) * slope + intercept
+    width = max(float(width), 1.0)
+    scaled = ((values - (center - 0.5)) / (width - 1) + 0.5) if width > 1 else (values >= center).astype(np.float64)
+    return (np.clip(scaled, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+class TileSource:
+    """Pyramid and tiles for one DICOM file, cached under cache_folder/<content_hash>"""
+
+    def __init__(self, dicom_path, content_hash, cache_folder, pixel_cache=None, tile_size=TILE_SIZE):
+        self.dicom_path = dicom_path
+        self.content_hash = content_hash
+        self.folder = os.path.join(cache_folder, content_hash)
+        self.pixel_cache = pixel_cache
+        self.tile_size = tile_size
+        self._lock = threading.Lock()
+        self._info = None
+        self._levels = {}
+        self._default_lut = None
+        self._touched = 0.0
+
+    def touch(self, every=3600):
+        """Mark the pyramid as used for storage retention, at most once per `every` seconds"""
+        now = time.time()
+        if now - self._touched > every:
+            self._touched = now
+            try:
+                os.utime(self.folder)
+            except OSError:
+                pass
+
+    def removed(self):
+        """True if the pyramid folder was built and has since been deleted (e.g. by the storage GC)"""
+        return self._info is not None and not os.path.isdir(self.folder)
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _pixels(self):
+        """Stored pixel values of the first frame, through the pixel cache when there is one"""
+        def decode():
+            with span('pixel_decode'):
+                return pydicom.dcmread(self.dicom_path).pixel_array
+
+        pixels = self.pixel_cache.get(self.content_hash, decode) if self.pixel_cache else decode()
+        if pixels.ndim == 3 and pixels.shape[-1] not in (3, 4):
+            pixels = pixels[0]
+        return pixels
+
+    def _decode(self):
+        """Inspect the pixels once and write the default LUT and info.json"""
+        os.makedirs(self.folder, exist_ok=True)
+        ds = read_header(self.dicom_path)
+        pixels = self._pixels()
+
+        info = {'width': int(pixels.shape[1]), 'height': int(pixels.shape[0]), 'tile_size': self.tile_size}
+        windowable = pixels.ndim == 2 and pixels.dtype.kind in 'ui' and pixels.dtype.itemsize <= 2
+        if windowable:
+            p_min, p_max = int(pixels.min()), int(pixels.max())
+            windowed = np.asarray(apply_voi_lut(np.arange(p_min, p_max + 1), ds), dtype=np.float32)
+            lut = _scale_to_uint8(windowed, float(windowed.min()), float(windowed.max()))
+            slope = float(ds.get('RescaleSlope', 1) or 1)
+            intercept = float(ds.get('RescaleIntercept', 0) or 0)
+            # Initial window for the viewer's controls: the dataset's own, else the full range
+            low, high = p_min * slope + intercept, p_max * slope + intercept
+            center, width = (low + high) / 2, high - low
+            if 'WindowCenter' in ds and 'WindowWidth' in ds:
+                center, width = (float(v[0] if isinstance(v, pydicom.multival.MultiValue) else v)
+                                 for v in (ds.WindowCenter, ds.WindowWidth))
+            info.update(windowable=True, p_min=p_min, p_max=p_max, slope=slope, intercept=intercept,
+                        window_center=center, window_width=width)
+            _save_npy(self._path('default_lut.npy'), lut)
+        else:
+            info['windowable'] = False
+
+        longest = max(info['width'], info['height'])
+        max_zoom = 0
+        while (self.tile_size << max_zoom) < longest:
+            max_zoom += 1
+        info['max_zoom'] = max_zoom
+
+        if not windowable:
+            # Colour or float data: the top level is the already windowed 8-bit image
+            _save_npy(self._path(f'level_{max_zoom}.npy'), window_pixels(ds, pixels))
+        _write_atomic(self._path('info.json'), lambda f: f.write(json.dumps(info).encode('utf-8')))
+        return info
+
+    @property
+    def info(self):
+        if self._info is None:
+            with self._lock:
+                if self._info is None:
+                    try:
+                        with open(self._path('info.json')) as f:
+                            self._info = json.load(f)
+                    except FileNotFoundError:
+                        self._info = self._decode()
+        return self._info
+
+    def level(self, z):
+        """Pixel array of zoom level z, memory-mapped from disk and built on first use"""
+        max_zoom = self.info['max_zoom']
+        if not 0 <= z <= max_zoom:
+            raise TileNotFound(f'Zoom level {z} outside 0..{max_zoom}')
+        if z in self._levels:
+            return self._levels[z]
+
+        if z == max_zoom and self.info['windowable']:
+            array = self._pixels()
+        else:
+            path = self._path(f'level_{z}.npy')
+            if not os.path.exists(path):
+                finer = self.level(z + 1)
+                with self._lock:
+                    if not os.path.exists(path):
+                        _save_npy(path, halve(finer))
+            array = np.load(path, mmap_mode='r')
+        self._levels[z] = array
+        return array
+
+    def _lut(self, center, width):
+        info = self.info
+        if center is None or width is None:
+            if self._default_lut is None:
+                self._default_lut = np.load(self._path('default_lut.npy'))
+            return self._default_lut
+        return _cached_window_lut(info['p_min'], info['p_max'], float(center), float(width),
+                                  info['slope'], info['intercept'])
+
+    def render_tile(self, z, x, y, center=None, width=None):
+        level = self.level(z)
+        size = self.tile_size
+        if x < 0 or y < 0 or y * size >= level.shape[0] or x * size >= level.shape[1]:
+            raise TileNotFound(f'Tile {x},{y} outside zoom level {z}')
+        region = level[y * size:(y + 1) * size, x * size:(x + 1) * size]
+        if self.info['windowable']:
+            region = self._lut(center, width)[region.astype(np.int32) - self.info['p_min']]
+        return encode_png(np.ascontiguousarray(region))
+
+    def tile(self, z, x, y, center=None, width=None):
+        """PNG bytes for one tile; default-window tiles are cached on disk"""
+        if not self.info['windowable'] or center is None or width is None:
+            path = self._path(os.path.join('tiles', str(z), f'{x}_{y}.png'))
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+            payload = self.render_tile(z, x, y)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, lambda f: f.write(payload))
+            return payload
+        return self.render_tile(z, x, y, center, width)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_window_lut(p_min, p_max, center, width, slope, intercept):
+    return window_lut(p_min, p_max, center, width, slope, intercept)
+
+
+SOURCES_SIZE = 32
+
+_sources = OrderedDict()
+_sources_lock = threading.Lock()
+
+
+def get_tile_source(dicom_path, content_hash, cache_folder, pixel_cache=None):
+    """Shared TileSource per image, so its memory maps are reused across requests.
+
+    Only the SOURCES_SIZE most recently viewed images stay open.
+    """
+    with _sources_lock:
+        source = _sources.get(content_hash)
+        if source is None or source.removed():
+            # A removed pyramid is rebuilt by a fresh source; the old one would miss its files
+            source = _sources[content_hash] = TileSource(dicom_path, content_hash, cache_folder, pixel_cache)
+            _sources.move_to_end(content_hash)
+            while len(_sources) > SOURCES_SIZE:
+                _sources.popitem(last=False)
+        else:
+            _sources.move_to_end(content_hash)
+    source.touch()
+    return source
@@ -0,0 +1,169 @@
+"""Streaming multipart uploads written straight to content-addressed files.
+
+Werkzeug normally spools each uploaded file into a temporary file (or
+memory) and file.save() then copies it again. StreamingRequest instead
+hands the multipart parser a HashingFileStream for the endpoints listed in
+app.config['STREAMING_UPLOADS']: chunks go to a temporary file in the
+destination folder while the SHA-256 is updated and the file signature is
+checked, and commit() renames the file to <sha256>.<ext>. A part with the
+wrong signature aborts the request as soon as its first bytes arrive; one
+too short to hold the signature aborts it once the body has been parsed.
+"""
+import hashlib
+import os
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest
+
+# (offset, signature) that the first bytes of a file must contain
+DICOM_MAGIC = (128, b'DICM')
+PDF_MAGIC = (0, b'%PDF')
+
+
+class UploadRejected(BadRequest):
+    """An uploaded file failed the signature check"""
+
+
+class DiscardStream:
+    """Sink for parts we are not going to store (e.g. wrong extension)"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        return b''
+
+    def readline(self, size=-1):
+        return b''
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class HashingFileStream:
+    """Writes one uploaded part to disk, hashing and validating it on the way"""
+
+    def __init__(self, folder, extension, magic, filename):
+        fd, self.temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self._head = b''
+        self.folder = folder
+        self.extension = extension
+        self.magic_offset, self.magic = magic
+        self.filename = filename
+        self.size = 0
+        self.path = None
+        self.content_hash = None
+
+    @property
+    def verified(self):
+        return self._head is None
+
+    def _check_magic(self, data):
+        needed = self.magic_offset + len(self.magic)
+        self._head += data[:needed - len(self._head)]
+        if len(self._head) < needed:
+            return
+        if self._head[self.magic_offset:needed] != self.magic:
+            self.discard()
+            raise UploadRejected(f'Rejected {self.filename}: missing {self.magic.decode()} file signature')
+        self._head = None
+
+    def write(self, data):
+        if self._head is not None:
+            self._check_magic(data)
+        self._sha.update(data)
+        self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def commit(self):
+        """Move the part to <folder>/<sha256>.<ext> and return (path, sha256)"""
+        if self.path is not None:
+            return self.path, self.content_hash
+        if not self.verified:
+            self.discard()
+            raise UploadRejected(f'Rejected {self.filename}: file too short')
+
+        self._file.close()
+        self.content_hash = self._sha.hexdigest()
+        path = os.path.join(self.folder, f'{self.content_hash}.{self.extension}')
+        if os.path.exists(path):
+            # Same content already stored; keep the existing file, marked as recently used
+            # so the storage GC does not take it for an old orphan
+            os.remove(self.temp_path)
+            os.utime(path)
+        else:
+            os.replace(self.temp_path, path)
+        self.path = path
+        return self.path, self.content_hash
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.path is None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def close(self):
+        if self.path is None:
+            self.discard()
+
+
+class StreamingRequest(Request):
+    """Request class that streams uploads for the configured endpoints.
+
+    app.config['STREAMING_UPLOADS'] maps an endpoint name to
+    (folder config key, allowed extensions, (offset, magic), stored extension).
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        target = current_app.config.get('STREAMING_UPLOADS', {}).get(self.endpoint)
+        if target is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+        folder_key, extensions, magic, stored_extension = target
+        extension = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        if extension not in extensions:
+            return DiscardStream()
+
+        stream = HashingFileStream(current_app.config[folder_key], stored_extension, magic, filename)
+        self.__dict__.setdefault('_upload_streams', []).append(stream)
+        return stream
+
+    def _load_form_data(self):
+        super()._load_form_data()
+        for stream in self.__dict__.get('_upload_streams', ()):
+            if not stream.verified:
+                stream.discard()
+                raise UploadRejected(f'Rejected {stream.filename}: file too short')
+
+    def close(self):
+        super().close()
+        # Parts that were never committed (rejected request, error in the
+        # view) leave no temporary files behind
+        for stream in self.__dict__.get('_upload_streams', ()):
+            stream.close()
@@ -0,0 +1,7 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from app import create_app
+
+application = create_app()